@@ -5,6 +5,8 @@ import numpy as np # To check the dot product
 import math
 import time
 from utils import signed_integer
+from prg import PRG
+from ring import BLOCK_ELEMENTS, accumulator_dtype, ring_dot, ring_dtype, ring_matmul, ring_matvec, ring_reduce, to_ring
 
 # Decorator to measure execution time
 def measure_time(func):
@@ -87,11 +89,12 @@ class MPC_Shares:
                 j = i - 1 % 3
                 break
 
-        # Compute the single share of the product belonging to party i
+        # Compute the single share of the product belonging to party i (the factors
+        # are reduced first so that the intermediate products stay below order^2)
         share_prod = (
-            (shares_1[i] + shares_1[j])
-            * (shares_2[i] + shares_2[j])
-            - (shares_1[j] * shares_2[j])
+            ((shares_1[i] + shares_1[j]) % self.order)
+            * ((shares_2[i] + shares_2[j]) % self.order)
+            - (shares_1[j] % self.order) * (shares_2[j] % self.order)
             + r
         ) % self.order
 
@@ -114,21 +117,220 @@ class MPC_Shares:
 
         shares_vector_1 = self.vector_shares
         shares_vector_2 = shares_obj_to_dot_prod.vector_shares
+        k = int(math.log2(self.order))
 
-        products = []
-        for i in range(len(shares_vector_1)):
-            product = shares_vector_1[i].LocalMultiplication(shares_vector_2[i])
-            products.append(product)
+        # Party ID (found once for the whole vector)
+        for i in range(3):
+            if shares_vector_1[0].shares[i] == inf:
+                i = i - 1 % 3
+                j = i - 1 % 3
+                break
+
+        # Gather the two components held by this party into contiguous arrays
+        n = len(shares_vector_1)
+        dtype = ring_dtype(k)
+        a_i = np.fromiter((s.shares[i] % self.order for s in shares_vector_1), dtype=dtype, count=n)
+        a_j = np.fromiter((s.shares[j] % self.order for s in shares_vector_1), dtype=dtype, count=n)
+        b_i = np.fromiter((s.shares[i] % self.order for s in shares_vector_2), dtype=dtype, count=n)
+        b_j = np.fromiter((s.shares[j] % self.order for s in shares_vector_2), dtype=dtype, count=n)
+
+        # (a_i + a_j)·(b_i + b_j) - a_j·b_j as array operations
+        share_dot_product = (
+            ring_dot(ring_reduce(a_i + a_j, k), ring_reduce(b_i + b_j, k), k)
+            - ring_dot(a_j, b_j, k)
+            + r
+        )
+
+        return share_dot_product % self.order
+
+# Class to handle the local shares of a whole array of secrets.
+# Party p (0, 1, 2 for P1, P2, P3) holds the replicated components p and p-1,
+# stored as two contiguous arrays of the ring dtype (see ring.ring_dtype).
+class MPC_ArrayShares:
+    def __init__(
+        self, share_i: np.ndarray, share_j: np.ndarray, party: int, order: int
+    ) -> MPC_ArrayShares:
+
+        # Check the shape and dtype of both components
+        assert (
+            share_i.shape == share_j.shape and share_i.dtype == share_j.dtype
+        ), "Exception: Both components must have the same shape and dtype."
+        assert party in (0, 1, 2), "Exception: The party id must be 0, 1 or 2."
+
+        self.order = order
+        self.k = int(math.log2(order))
+        self.party = party
+        self.share_i = share_i
+        self.share_j = share_j
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.share_i.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.share_i.dtype
+
+    def __len__(self) -> int:
+        return len(self.share_i)
+
+    # Select elements/rows of the shared array
+    def __getitem__(self, index) -> MPC_ArrayShares:
+        return MPC_ArrayShares(
+            np.asarray(self.share_i[index]), np.asarray(self.share_j[index]), self.party, self.order
+        )
+
+    def _check_compatible(self, shares_obj: MPC_ArrayShares) -> None:
+        assert (
+            self.order == shares_obj.order
+        ), "Exception: The shares objects must have the same order."
+        assert (
+            self.party == shares_obj.party
+        ), "Exception: The shares objects must belong to the same party."
+
+    # Locally adding 2 shared arrays
+    def LocalAddition(self, shares_obj_to_add: MPC_ArrayShares) -> MPC_ArrayShares:
+        self._check_compatible(shares_obj_to_add)
+        share_i = ring_reduce(self.share_i + shares_obj_to_add.share_i, self.k)
+        share_j = ring_reduce(self.share_j + shares_obj_to_add.share_j, self.k)
+        return MPC_ArrayShares(share_i, share_j, self.party, self.order)
+
+    # Locally subtracting 2 shared arrays
+    def LocalSubtraction(self, shares_obj_to_sub: MPC_ArrayShares) -> MPC_ArrayShares:
+        self._check_compatible(shares_obj_to_sub)
+        share_i = ring_reduce(self.share_i - shares_obj_to_sub.share_i, self.k)
+        share_j = ring_reduce(self.share_j - shares_obj_to_sub.share_j, self.k)
+        return MPC_ArrayShares(share_i, share_j, self.party, self.order)
+
+    # Locally adding public values: they are added to the component 0, held by P1 and P2
+    def LocalAddPublic(self, values) -> MPC_ArrayShares:
+        values = to_ring(values, self.k)
+        share_i, share_j = self.share_i, self.share_j
+        if self.party == 0:
+            share_i = ring_reduce(share_i + values, self.k)
+        elif self.party == 1:
+            share_j = ring_reduce(share_j + values, self.k)
+        else:
+            share_i, share_j = np.broadcast_arrays(share_i, values)[0], np.broadcast_arrays(share_j, values)[0]
+        return MPC_ArrayShares(np.array(share_i), np.array(share_j), self.party, self.order)
+
+    # Locally multiplying by public values
+    def LocalScale(self, values) -> MPC_ArrayShares:
+        values = to_ring(values, self.k)
+        share_i = ring_reduce(self.share_i * values, self.k)
+        share_j = ring_reduce(self.share_j * values, self.k)
+        return MPC_ArrayShares(share_i, share_j, self.party, self.order)
+
+    # Locally multiplying 2 shared arrays element-wise. The result is the array
+    # of single (3-out-of-3) shares of the products belonging to this party
+    def LocalMultiplication(
+        self, shares_obj_to_mult: MPC_ArrayShares, r: np.ndarray | int = 0
+    ) -> np.ndarray:
+        self._check_compatible(shares_obj_to_mult)
+        a_i, a_j = self.share_i, self.share_j
+        b_i, b_j = shares_obj_to_mult.share_i, shares_obj_to_mult.share_j
+
+        share_prod = (a_i + a_j) * (b_i + b_j) - a_j * b_j
+        if not np.isscalar(r) or r != 0:
+            share_prod = share_prod + to_ring(r, self.k)
+        return ring_reduce(share_prod, self.k)
+
+    # Compute the single share of the dot product of 2 shared vectors
+    def LocalDotProduct(
+        self, shares_obj_to_dot_prod: MPC_ArrayShares, r: int = 0
+    ) -> int:
+        assert (
+            self.share_i.ndim == 1 and shares_obj_to_dot_prod.share_i.ndim == 1
+        ), "Exception: The objects must contain shares of vectors."
+        a_i, a_j = self.share_i, self.share_j
+        b_i, b_j = shares_obj_to_dot_prod.share_i, shares_obj_to_dot_prod.share_j
 
-        share_dot_product = 0
-        for i in range(len(products)):
-            share_dot_product += products[i]
+        # (a_i + a_j)·(b_i + b_j) - a_j·b_j reduced in one call per term
+        share_dot_product = (
+            ring_dot(ring_reduce(a_i + a_j, self.k), ring_reduce(b_i + b_j, self.k), self.k)
+            - ring_dot(a_j, b_j, self.k)
+            + r
+        )
+        return share_dot_product % self.order
+
+    # Compute the single shares of the product of a shared matrix (N x L)
+    # and a shared vector (L), i.e. N dot products in one matrix-vector product
+    def LocalMatrixVectorProduct(
+        self, shares_obj_vector: MPC_ArrayShares, r: np.ndarray | int = 0
+    ) -> np.ndarray:
+        self._check_compatible(shares_obj_vector)
+        assert (
+            self.share_i.ndim == 2 and shares_obj_vector.share_i.ndim == 1
+        ), "Exception: The objects must contain shares of a matrix and a vector."
 
-        return share_dot_product % self.order    
+        a_i, a_j = self.share_i, self.share_j
+        b_i, b_j = shares_obj_vector.share_i, shares_obj_vector.share_j
+
+        share_prod = (
+            ring_matvec(ring_reduce(a_i + a_j, self.k), ring_reduce(b_i + b_j, self.k), self.k)
+            - ring_matvec(a_j, b_j, self.k)
+        )
+        if not np.isscalar(r) or r != 0:
+            share_prod = share_prod + to_ring(r, self.k)
+        return ring_reduce(share_prod, self.k)
+
+    # Compute the single shares of the dot products between every row of this
+    # shared matrix (Q x L) and every row of another one (N x L), i.e. the
+    # Q x N matrix product self·other^T, tile by tile to bound peak memory (by
+    # default a tile of the right operand holds about BLOCK_ELEMENTS elements)
+    def LocalBatchDotProduct(
+        self,
+        shares_obj_rows: MPC_ArrayShares,
+        r: np.ndarray | int = 0,
+        tile_rows: int = 256,
+        tile_cols: int = None,
+        rows_sum: np.ndarray = None,
+    ) -> np.ndarray:
+        self._check_compatible(shares_obj_rows)
+        assert (
+            self.share_i.ndim == 2 and shares_obj_rows.share_i.ndim == 2
+        ), "Exception: The objects must contain shares of matrices."
+        assert (
+            self.shape[1] == shares_obj_rows.shape[1]
+        ), "Exception: The rows of both matrices must have the same length."
+
+        k = self.k
+        accumulator = accumulator_dtype(k, self.shape[1])
+        num_rows, num_cols = self.shape[0], shares_obj_rows.shape[0]
+        share_prod = np.empty((num_rows, num_cols), dtype=self.dtype)
+        if tile_cols is None:
+            tile_cols = max(1, BLOCK_ELEMENTS // max(1, self.shape[1]))
+
+        # Outer loop over tiles of the (large) right operand, so that its recombined
+        # components are computed once per tile
+        for col in range(0, num_cols, tile_cols):
+            # The recombined b_i + b_j may be precomputed by the caller (rows_sum),
+            # e.g. for a gallery (see SharedGallery.EnablePrecompute)
+            b_i = shares_obj_rows.share_i[col:col + tile_cols]
+            b_j = shares_obj_rows.share_j[col:col + tile_cols]
+            if rows_sum is not None:
+                b_sum = rows_sum[col:col + tile_cols].astype(accumulator).T
+            else:
+                b_sum = ring_reduce(b_i + b_j, k).astype(accumulator).T
+            b_j = b_j.astype(accumulator).T
+
+            for row in range(0, num_rows, tile_rows):
+                a_i = self.share_i[row:row + tile_rows]
+                a_j = self.share_j[row:row + tile_rows]
+                a_sum = ring_reduce(a_i + a_j, k)
+
+                # (a_i + a_j)·(b_i + b_j) - a_j·b_j for the whole tile
+                share_prod[row:row + tile_rows, col:col + tile_cols] = (
+                    ring_matmul(a_sum, b_sum, k) - ring_matmul(a_j, b_j, k)
+                )
+
+        if not np.isscalar(r) or r != 0:
+            share_prod = share_prod + to_ring(r, k)
+        return ring_reduce(share_prod, k)
 
 # Class to handle the Global MPC operations
 class MPC:
-    def __init__(self, k: int=16, order: int=None) -> MPC:
+    def __init__(self, k: int=16, order: int=None, seed: bytes=None) -> MPC:
         if order is not None:
             k = math.log2(order)
             assert k.is_integer(), "Exception: The order must be a power of 2." 
@@ -138,10 +340,12 @@ class MPC:
             self.order = 2**k
             self.k = k
 
+        # Cryptographic generator of the random components of the shares
+        self.prg = PRG(seed)
+
     def SplitSecret(self, secret: int) -> tuple[MPC_Shares, MPC_Shares, MPC_Shares]:
-        # Split the secret into 2 shares
-        share1 = random.randint(1, self.order)
-        share2 = random.randint(1, self.order)
+        # Split the secret into 3 shares (2 of them uniformly random in [0, order))
+        share1, share2 = self.prg.RandomRing(2, int(self.k)).tolist()
         share3 = (secret - share1 - share2) % self.order
 
         # Distribute the shares among the parties
@@ -180,11 +384,17 @@ class MPC:
         temp_shares_vector_p2 = []
         temp_shares_vector_p3 = []
 
-        for i in range(len(vector)):
-            shares = self.SplitSecret(vector[i])
-            temp_shares_vector_p1.append(shares[0])
-            temp_shares_vector_p2.append(shares[1])
-            temp_shares_vector_p3.append(shares[2])
+        # Draw the random shares of the whole vector in one call
+        k = int(self.k)
+        masks = self.prg.RandomRing((2, len(vector)), k)
+        shares1 = masks[0].tolist()
+        shares2 = masks[1].tolist()
+        shares3 = ring_reduce(to_ring(vector, k) - masks[0] - masks[1], k).tolist()
+
+        for share1, share2, share3 in zip(shares1, shares2, shares3):
+            temp_shares_vector_p1.append(MPC_Shares([share1, inf, share3], self.order))
+            temp_shares_vector_p2.append(MPC_Shares([share1, share2, inf], self.order))
+            temp_shares_vector_p3.append(MPC_Shares([inf, share2, share3], self.order))
 
         shares_vector_p1 = MPC_Shares(temp_shares_vector_p1, self.order)
         shares_vector_p2 = MPC_Shares(temp_shares_vector_p2, self.order)
@@ -200,6 +410,53 @@ class MPC:
             recovered_vector.append(secret)
         return recovered_vector
 
+    # Split a whole array of secrets into replicated shares backed by NumPy arrays
+    def SplitArraySecret(self, array) -> tuple[MPC_ArrayShares, MPC_ArrayShares, MPC_ArrayShares]:
+        k = int(self.k)
+        secret = to_ring(array, k)
+
+        # Split the secrets into 3 components (all random masks drawn in one call)
+        masks = self.prg.RandomRing((2,) + secret.shape, k)
+        share1, share2 = masks[0], masks[1]
+        share3 = ring_reduce(secret - share1 - share2, k)
+
+        # Distribute the components among the parties (each party owns its arrays)
+        shares_obj_p1 = MPC_ArrayShares(share1, share3, 0, self.order)
+        shares_obj_p2 = MPC_ArrayShares(share2, share1.copy(), 1, self.order)
+        shares_obj_p3 = MPC_ArrayShares(share3.copy(), share2.copy(), 2, self.order)
+
+        return shares_obj_p1, shares_obj_p2, shares_obj_p3
+
+    # Reconstruct a shared array. Only 2 parties are needed to reconstruct the secret
+    def ReconstructArraySecret(self, sharesA: MPC_ArrayShares, sharesB: MPC_ArrayShares) -> np.ndarray:
+
+        assert sharesA.party != sharesB.party, "Exception: The shares must belong to different parties."
+
+        # Components held by each party
+        components = {
+            sharesA.party: sharesA.share_i,
+            (sharesA.party - 1) % 3: sharesA.share_j,
+            sharesB.party: sharesB.share_i,
+            (sharesB.party - 1) % 3: sharesB.share_j,
+        }
+        secret = components[0] + components[1] + components[2]
+
+        return ring_reduce(secret, int(self.k))
+
+    # Resharing arrays of products of secrets (one array of single shares per party)
+    def ArrayResharing(
+        self, share1: np.ndarray, share2: np.ndarray, share3: np.ndarray
+    ) -> tuple[MPC_ArrayShares, MPC_ArrayShares, MPC_ArrayShares]:
+
+        share1, share2, share3 = (to_ring(s, int(self.k)) for s in (share1, share2, share3))
+
+        # Distribute the shares among the parties (each party owns its arrays)
+        shares_obj_p1 = MPC_ArrayShares(share1, share3, 0, self.order)
+        shares_obj_p2 = MPC_ArrayShares(share2, share1.copy(), 1, self.order)
+        shares_obj_p3 = MPC_ArrayShares(share3.copy(), share2.copy(), 2, self.order)
+
+        return shares_obj_p1, shares_obj_p2, shares_obj_p3
+
     # Resharing the product of two secrets
     def Resharing(self, share1: int, share2: int, share3: int) -> tuple[MPC_Shares, MPC_Shares, MPC_Shares]:
 
@@ -334,7 +591,7 @@ def test_mpc(num_tests):
 
     print("\nNumber of errors: ", num_errors, " out of ", num_tests)
 
-if "__name__" == "__main__":
+if __name__ == "__main__":
     # Simple test
     simple_test()
 
@@ -0,0 +1,255 @@
+# Benchmark suite of the 3-party matcher.
+# Sweeps the vector length, the gallery size N, the query batch size, the ring size k
+# and the number of workers over the operations of a 1:N search (split, local dot
+# products, reshare, reconstruct and the full search between 3 party processes), and
+# reports per run the wall-clock and CPU time, the throughput, the peak RSS and the
+# bytes sent on the wire. Every point of the sweep runs in a fresh process, so its peak
+# RSS is its own. The results are written as JSON, and a previous results file can be
+# given to compare against (e.g. the results of the previous version).
+#   python bench.py --quick --output results.json
+#   python bench.py --output new.json --compare results.json
+from __future__ import annotations
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import numpy as np
+from MPC import MPC, MPC_ArrayShares
+from gallery import SharedGallery, split_gallery
+from party_runtime import PartyRuntime, picklable_error, run_parties
+from sharded import ShardedMatcher
+from utils import mask_bits
+from wire import decode_frame, frame_bytes
+
+# Default sweeps (--quick runs one small point of each)
+SWEEPS = {
+    "vector_length": [1000, 10000],
+    "num_codes": [1000, 10000],
+    "batch_size": [1, 16],
+    "k": [16, 32],
+    "workers": [1, 2],
+}
+QUICK_SWEEPS = {
+    "vector_length": [1000],
+    "num_codes": [1000],
+    "batch_size": [1, 8],
+    "k": [16],
+    "workers": [1],
+}
+
+# Parameters identifying a run (for the comparison between results files)
+KEY_FIELDS = ("operation", "vector_length", "num_codes", "batch_size", "k", "workers")
+
+# Peak resident set size of this process and of its finished children, in kB
+def peak_rss_kb() -> int:
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+# CPU time of running processes in seconds, from /proc (0 where it is not available)
+def process_cpu_time(pids: list[int]) -> float:
+    total = 0.0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError):
+            pass
+    return total
+
+# CPU time of this process and of its finished children, in seconds
+def cpu_time() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+# Run `function` `repeats` times and keep the median wall-clock and CPU times
+def measure(function, repeats: int) -> dict:
+    walls, cpus = [], []
+    for _ in range(repeats):
+        cpu_start, wall_start = cpu_time(), time.perf_counter()
+        function()
+        walls.append(time.perf_counter() - wall_start)
+        cpus.append(cpu_time() - cpu_start)
+    return {"wall_s": float(np.median(walls)), "cpu_s": float(np.median(cpus)), "peak_rss_kb": peak_rss_kb()}
+
+# Random masked codes (values in {-1, 0, 1})
+def random_codes(shape: tuple) -> np.ndarray:
+    return mask_bits(np.random.randint(0, 2, shape), np.random.randint(0, 2, shape))
+
+# Party function of the full search: score the batch of queries, reshare and open.
+# The time is measured inside the party, after the connections are set up and the
+# worker pool (if any) is started; the CPU time includes the one of the workers
+def search_party(runtime: PartyRuntime, gallery_path: str, query_shares: MPC_ArrayShares, workers: int) -> tuple:
+    zero_sharing = runtime.SetupZeroSharing()
+    matcher = ShardedMatcher(gallery_path, num_workers=workers) if workers > 1 else SharedGallery.Open(gallery_path)
+    scores_shape = query_shares.shape[:-1] + (matcher.num_codes,)
+    worker_pids = []
+    if workers > 1:
+        matcher.LocalMatch(query_shares)
+        worker_pids = matcher.worker_pids
+
+    cpu_start, wall_start = time.process_time() + process_cpu_time(worker_pids), time.perf_counter()
+    if workers > 1 or len(query_shares.shape) == 1:
+        share_scores = matcher.LocalMatch(query_shares, r=zero_sharing.Next(scores_shape))
+    else:
+        share_scores = matcher.LocalMatchBatch(query_shares, r=zero_sharing.Next(scores_shape))
+    scores = runtime.Open(runtime.Reshare(share_scores))
+    elapsed = time.perf_counter() - wall_start
+    cpu = time.process_time() + process_cpu_time(worker_pids) - cpu_start
+
+    if workers > 1:
+        matcher.Close()
+    return elapsed, cpu, scores.shape
+
+# Benchmark the operations for one point of the sweep
+def bench_point(vector_length: int, num_codes: int, batch_size: int, k: int, workers: int, repeats: int, directory: str) -> list[dict]:
+    params = {"vector_length": vector_length, "num_codes": num_codes, "batch_size": batch_size, "k": k, "workers": workers}
+    mpc = MPC(k)
+    codes_db = random_codes((num_codes, vector_length))
+    queries = random_codes((batch_size, vector_length) if batch_size > 1 else (vector_length,))
+    num_scores = num_codes * batch_size
+    records = []
+
+    def record(operation, measured, throughput, unit, bytes_sent=0):
+        records.append({"operation": operation, **params, **measured, "throughput": throughput, "unit": unit, "bytes_sent": bytes_sent})
+
+    # Splitting of the gallery (dealer)
+    measured = measure(lambda: mpc.SplitArraySecret(codes_db), repeats)
+    record("split", measured, codes_db.size / measured["wall_s"], "elements/s")
+
+    galleries = split_gallery(mpc, codes_db)
+    query_shares = mpc.SplitArraySecret(queries)
+
+    # Local dot products of one party (the worker count applies to the full search)
+    if batch_size > 1:
+        measured = measure(lambda: galleries[0].LocalMatchBatch(query_shares[0]), repeats)
+    else:
+        measured = measure(lambda: galleries[0].LocalMatch(query_shares[0]), repeats)
+    record("dot_product", measured, num_scores / measured["wall_s"], "scores/s")
+
+    # Reshare: encoding, decoding and redistribution of the single shares
+    z = [galleries[p].LocalMatch(query_shares[p]) if batch_size == 1 else galleries[p].LocalMatchBatch(query_shares[p]) for p in range(3)]
+    frame_size = len(frame_bytes([z[0]], k))
+    measured = measure(lambda: mpc.ArrayResharing(*[decode_frame(frame_bytes([share], k))[0] for share in z]), repeats)
+    record("reshare", measured, num_scores / measured["wall_s"], "scores/s", frame_size)
+
+    # Reconstruction (opening) of the scores
+    shares = mpc.ArrayResharing(*z)
+    measured = measure(lambda: mpc.ReconstructArraySecret(shares[0], shares[1]), repeats)
+    record("reconstruct", measured, num_scores / measured["wall_s"], "scores/s", frame_size)
+
+    # Full 1:N search between 3 party processes
+    paths = []
+    for gallery in galleries:
+        paths.append(os.path.join(directory, f"N{num_codes}_L{vector_length}_k{k}_party{gallery.party}"))
+        gallery.Save(paths[-1])
+    walls, cpus = [], []
+    for _ in range(repeats):
+        results = run_parties(search_party, [(paths[p], query_shares[p], workers) for p in range(3)], k)
+        walls.append(max(elapsed for (elapsed, _, _), _, _ in results))
+        cpus.append(sum(cpu for (_, cpu, _), _, _ in results))
+    bytes_sent = max(sent for _, sent, _ in results)
+    measured = {"wall_s": float(np.median(walls)), "cpu_s": float(np.median(cpus)), "peak_rss_kb": peak_rss_kb()}
+    record("search", measured, num_scores / measured["wall_s"], "scores/s", bytes_sent)
+    return records
+
+# Run bench_point in a fresh process, so that the peak RSS of every point is its own
+def isolated_bench_point(**params) -> list[dict]:
+    context = mp.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+
+    def child():
+        try:
+            sender.send((None, bench_point(**params)))
+        except BaseException as error:
+            sender.send((picklable_error(error), None))
+            raise
+
+    process = context.Process(target=child)
+    process.start()
+    sender.close()
+    try:
+        error, records = receiver.recv()
+    except EOFError:
+        error, records = RuntimeError(f"Exception: The benchmark process failed (exit code {process.exitcode})."), None
+    process.join()
+    if error is not None:
+        raise error
+    return records
+
+# Versions and machine of the run
+def environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+# Print the ratio of the wall-clock times against a previous results file
+def compare(records: list[dict], baseline_path: str) -> None:
+    with open(baseline_path) as f:
+        baseline = {tuple(r[key] for key in KEY_FIELDS): r for r in json.load(f)["results"]}
+    print(f"\nComparison against {baseline_path} (wall-clock time, new / old):")
+    for r in records:
+        old = baseline.get(tuple(r[key] for key in KEY_FIELDS))
+        if old is not None:
+            ratio = r["wall_s"] / old["wall_s"] if old["wall_s"] > 0 else float("inf")
+            flag = "  <-- slower" if ratio > 1.1 else ""
+            print(f"{r['operation']:12s} " + " ".join(f"{key}={r[key]}" for key in KEY_FIELDS[1:]) + f": {ratio:.2f}x{flag}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the 3-party matcher")
+    parser.add_argument("--quick", action="store_true", help="run a small sweep")
+    for name in SWEEPS:
+        parser.add_argument("--" + name.replace("_", "-"), type=int, nargs="+", help=f"values of {name}")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per measurement (the median is kept)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random codes")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file of the results")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    args = parser.parse_args()
+
+    sweeps = dict(QUICK_SWEEPS if args.quick else SWEEPS)
+    for name in SWEEPS:
+        if getattr(args, name) is not None:
+            sweeps[name] = getattr(args, name)
+
+    np.random.seed(args.seed)
+    directory = tempfile.mkdtemp()
+    records = []
+    for point in itertools.product(*sweeps.values()):
+        params = dict(zip(sweeps, point))
+        for r in isolated_bench_point(**params, repeats=args.repeats, directory=directory):
+            records.append(r)
+            print(
+                f"{r['operation']:12s} " + " ".join(f"{key}={r[key]}" for key in KEY_FIELDS[1:])
+                + f": {r['wall_s'] * 1000:9.2f} ms wall, {r['cpu_s'] * 1000:9.2f} ms cpu,"
+                + f" {r['throughput']:.3g} {r['unit']}, {r['bytes_sent']} bytes, peak RSS {r['peak_rss_kb']} kB"
+            )
+
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(), "sweeps": sweeps, "results": records}, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(records, args.compare)
+
+if __name__ == "__main__":
+    main()
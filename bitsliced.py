@@ -0,0 +1,357 @@
+# Bit-sliced matching: the iris codes and masks are kept as packed bits (64 per
+# uint64 word) under replicated XOR-sharing, instead of one ring element per bit.
+# Party p (0, 1, 2 for P1, P2, P3) holds the components p and p-1 of x = x_1 ^ x_2 ^ x_3.
+#   - XOR is local
+#   - AND is local up to a 3-out-of-3 XOR-sharing, re-randomized with a boolean
+#     zero-sharing and reshared (one round, 1 bit per AND gate)
+#   - The set bits (the Hamming and mask overlap counts) are counted by a boolean
+#     circuit (BooleanCircuit.PopCount) on the XOR-shares: a carry-save adder tree
+#     sums the words of a row lane by lane (1 AND round per level for all the weights),
+#     the 64 lanes are folded into one and the last 2 numbers are added with a
+#     Kogge-Stone adder
+#   - The k-bit counts, and only them, are converted to arithmetic shares
+#     (BooleanCircuit.ToArithmetic) with doubly-authenticated bits (daBits): random bits
+#     rho shared both as bits and as ring elements by the dealer. The parties open
+#     c = x ^ rho and, bit by bit, x_w = c_w + rho_w - 2 c_w rho_w
+# With the masked codes v = mask - 2 (code & mask) the masked dot product is
+#     <v_q, v_g> = |m| - 2 |m & d|,  m = m_q & m_g,  d = c_q ^ c_g
+# which is what the 1:N search computes from two counts per gallery row.
+from __future__ import annotations
+import numpy as np
+from MPC import MPC, MPC_ArrayShares
+from correlated import ZeroSharing, setup_zero_sharing
+from ring import ring_dtype, ring_reduce
+from utils import mask_bits, signed_integer
+
+# Number of bits per packed word
+WORD_BITS = 64
+
+# Number of words holding `nbits` packed bits
+def num_words(nbits: int) -> int:
+    return (int(nbits) + WORD_BITS - 1) // WORD_BITS
+
+# Pack the bits of the last axis, 64 per word (bit b of a row is bit b % 64 of word b // 64)
+def pack_bits(bits: np.ndarray) -> np.ndarray:
+    bits = np.asarray(bits, dtype=np.uint8)
+    nbits = bits.shape[-1]
+    padded = np.zeros(bits.shape[:-1] + (num_words(nbits) * WORD_BITS,), dtype=np.uint8)
+    padded[..., :nbits] = bits & 1
+    return np.packbits(padded, axis=-1, bitorder="little").view("<u8").astype(np.uint64, copy=False)
+
+# Unpack the first `nbits` bits of the last axis of packed words
+def unpack_bits(words: np.ndarray, nbits: int) -> np.ndarray:
+    words = np.ascontiguousarray(words, dtype="<u8")
+    return np.unpackbits(words.view(np.uint8), axis=-1, count=int(nbits), bitorder="little")
+
+# Mask of the low `width` bits of a word
+def low_bits_mask(width: int) -> np.uint64:
+    return np.uint64((1 << width) - 1) if width < WORD_BITS else np.uint64(2**64 - 1)
+
+# Class to handle the replicated XOR-shares of packed bits of one party
+class MPC_BitShares:
+    def __init__(self, bits_i: np.ndarray, bits_j: np.ndarray, party: int, nbits: int) -> MPC_BitShares:
+        assert bits_i.shape == bits_j.shape, "Exception: Both components must have the same shape."
+        assert bits_i.shape[-1] == num_words(nbits), "Exception: The number of words does not match the number of bits."
+        self.bits_i = bits_i
+        self.bits_j = bits_j
+        self.party = party
+        self.nbits = int(nbits)
+
+    @property
+    def shape(self) -> tuple:
+        return self.bits_i.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits_i.nbytes + self.bits_j.nbytes
+
+    def __len__(self) -> int:
+        return len(self.bits_i)
+
+    def __getitem__(self, index) -> MPC_BitShares:
+        return MPC_BitShares(self.bits_i[index], self.bits_j[index], self.party, self.nbits)
+
+    def _check_compatible(self, other: MPC_BitShares) -> None:
+        assert isinstance(other, MPC_BitShares), "Exception: The operand must be bit shares."
+        assert self.party == other.party, "Exception: The shares must belong to the same party."
+        assert self.nbits == other.nbits, "Exception: The shares must have the same number of bits."
+
+    # Locally XOR-ing 2 shared bit vectors (shapes broadcast, e.g. a query against a gallery)
+    def LocalXor(self, other: MPC_BitShares) -> MPC_BitShares:
+        self._check_compatible(other)
+        return MPC_BitShares(self.bits_i ^ other.bits_i, self.bits_j ^ other.bits_j, self.party, self.nbits)
+
+    # Locally AND-ing 2 shared bit vectors. The result is the single (3-out-of-3) XOR-share
+    # of this party, re-randomized with an XOR-sharing of zero r
+    def LocalAnd(self, other: MPC_BitShares, r: np.ndarray | int = 0) -> np.ndarray:
+        self._check_compatible(other)
+        z = (self.bits_i & other.bits_i) ^ (self.bits_i & other.bits_j) ^ (self.bits_j & other.bits_i)
+        return z ^ np.uint64(r) if np.isscalar(r) else z ^ r
+
+    # Value of the nbits-bit numbers (one per word) from the opened bits c = x ^ rho and
+    # this party's arithmetic shares of the daBits rho (shape (..., nbits)): bit w of x
+    # is c_w + rho_w - 2 c_w rho_w. Returns the arithmetic shares of the numbers
+    def LocalValue(self, opened: np.ndarray, dabits: MPC_ArrayShares) -> MPC_ArrayShares:
+        assert self.shape[-1] == 1, "Exception: The numbers must be one per word."
+        assert dabits.shape[-1] == self.nbits, "Exception: There must be one daBit per bit."
+        k = dabits.k
+        signs = unpack_bits(opened, self.nbits).astype(bool)
+        weights = np.left_shift(np.uint64(1), np.arange(self.nbits, dtype=np.uint64))
+
+        # sum_w 2^w (rho_w - 2 c_w rho_w) = rho with the sign flipped where c is set
+        share_i = (np.where(signs, -dabits.share_i, dabits.share_i).astype(np.uint64) * weights).sum(axis=-1, dtype=np.uint64)
+        share_j = (np.where(signs, -dabits.share_j, dabits.share_j).astype(np.uint64) * weights).sum(axis=-1, dtype=np.uint64)
+        values = MPC_ArrayShares(
+            ring_reduce(share_i, k).astype(dabits.dtype), ring_reduce(share_j, k).astype(dabits.dtype),
+            self.party, dabits.order,
+        )
+        return values.LocalAddPublic(opened[..., 0])
+
+# Words `index` (slice of the last axis) of bit shares
+def select_words(shares: MPC_BitShares, index: slice) -> MPC_BitShares:
+    bits_i, bits_j = shares.bits_i[..., index], shares.bits_j[..., index]
+    return MPC_BitShares(bits_i, bits_j, shares.party, WORD_BITS * bits_i.shape[-1])
+
+# Concatenation of the words of bit shares of the same party
+def concatenate_words(shares: list[MPC_BitShares]) -> MPC_BitShares:
+    bits_i = np.concatenate([s.bits_i for s in shares], axis=-1)
+    bits_j = np.concatenate([s.bits_j for s in shares], axis=-1)
+    return MPC_BitShares(bits_i, bits_j, shares[0].party, WORD_BITS * bits_i.shape[-1])
+
+# Local right shift of the words of bit shares, keeping the low `width` bits
+def fold_bits(shares: MPC_BitShares, distance: int, width: int) -> MPC_BitShares:
+    mask, distance = low_bits_mask(width), np.uint64(distance)
+    return MPC_BitShares((shares.bits_i >> distance) & mask, (shares.bits_j >> distance) & mask, shares.party, shares.nbits)
+
+# Local left shift of the k-bit elements of XOR-shares (dropping the overflowing bits)
+def shift_bits(shares: MPC_BitShares, distance: int) -> MPC_BitShares:
+    mask = low_bits_mask(shares.nbits)
+    distance = np.uint64(distance)
+    return MPC_BitShares(
+        (shares.bits_i << distance) & mask, (shares.bits_j << distance) & mask, shares.party, shares.nbits
+    )
+
+# Local extraction of the bit b of the k-bit elements of XOR-shares
+def select_bit(shares: MPC_BitShares, b: int) -> MPC_BitShares:
+    b = np.uint64(b)
+    one = np.uint64(1)
+    return MPC_BitShares((shares.bits_i >> b) & one, (shares.bits_j >> b) & one, shares.party, 1)
+
+# Class to handle the dealer operations of the boolean sharing (splitting, resharing,
+# reconstruction and daBits), next to the arithmetic MPC class
+class MPC_Bits:
+    def __init__(self, mpc: MPC) -> MPC_Bits:
+        self.mpc = mpc
+        self.prg = mpc.prg
+
+    # Random packed words, with the padding bits of the last word cleared
+    def _RandomWords(self, shape: tuple, nbits: int) -> np.ndarray:
+        words = self.prg.RandomRing(shape, 64)
+        if nbits % WORD_BITS:
+            words[..., -1] &= np.uint64((1 << (nbits % WORD_BITS)) - 1)
+        return words
+
+    # Split bits (last axis) into the replicated XOR-shares of P1, P2 and P3
+    def SplitBits(self, bits: np.ndarray) -> tuple[MPC_BitShares, MPC_BitShares, MPC_BitShares]:
+        bits = np.asarray(bits)
+        nbits = bits.shape[-1]
+        words = pack_bits(bits)
+        share1 = self._RandomWords(words.shape, nbits)
+        share2 = self._RandomWords(words.shape, nbits)
+        share3 = words ^ share1 ^ share2
+
+        P1_shares = MPC_BitShares(share1, share3, 0, nbits)
+        P2_shares = MPC_BitShares(share2, share1.copy(), 1, nbits)
+        P3_shares = MPC_BitShares(share3.copy(), share2.copy(), 2, nbits)
+        return P1_shares, P2_shares, P3_shares
+
+    # Resharing of the single XOR-shares: party p sends z_p to party p+1
+    def BitResharing(self, z1: np.ndarray, z2: np.ndarray, z3: np.ndarray, nbits: int) -> tuple[MPC_BitShares, MPC_BitShares, MPC_BitShares]:
+        P1_shares = MPC_BitShares(z1, z3.copy(), 0, nbits)
+        P2_shares = MPC_BitShares(z2, z1.copy(), 1, nbits)
+        P3_shares = MPC_BitShares(z3, z2.copy(), 2, nbits)
+        return P1_shares, P2_shares, P3_shares
+
+    # Reconstruction of packed bits from the shares of 2 parties
+    def ReconstructBits(self, A: MPC_BitShares, B: MPC_BitShares) -> np.ndarray:
+        assert A.party != B.party, "Exception: The shares must belong to different parties."
+        P1, P2 = (A, B) if (A.party + 1) % 3 == B.party else (B, A)
+        # P2 holds the component that P1 lacks
+        return P1.bits_i ^ P1.bits_j ^ P2.bits_i
+
+    # Opening of c = x ^ rho: party p sends its component p to party p-1
+    def OpenBits(self, P1: MPC_BitShares, P2: MPC_BitShares, P3: MPC_BitShares) -> np.ndarray:
+        return P1.bits_i ^ P2.bits_i ^ P3.bits_i
+
+    # daBits: random bits shared both as packed XOR-shares and as ring elements
+    def DaBits(self, shape: tuple, nbits: int) -> tuple[tuple, tuple]:
+        bits = self.prg.RandomRing(tuple(shape) + (nbits,), 1).astype(np.uint8)
+        return self.SplitBits(bits), self.mpc.SplitArraySecret(bits)
+
+# Class to handle the boolean circuits evaluated by the 3 parties on XOR-shares: the AND
+# gates of a round are evaluated together, and the rounds and bits sent are counted
+class BooleanCircuit:
+    def __init__(
+        self, mpc_bits: MPC_Bits, zero_sharings: tuple[ZeroSharing, ZeroSharing, ZeroSharing], preprocessing=None
+    ) -> BooleanCircuit:
+        self.mpc_bits = mpc_bits
+        self.zero_sharings = zero_sharings
+
+        # Source of the daBits: a preprocessing.Preprocessor, or the dealer inline
+        self.dealer = preprocessing if preprocessing is not None else mpc_bits
+
+        # Number of communication rounds and bits sent per party
+        self.rounds = 0
+        self.bits_sent = 0
+
+    # One round of AND gates: every pair (x, y) holds the shares of the 3 parties,
+    # and all the pairs are reshared together
+    def AndRound(self, pairs: list[tuple[list[MPC_BitShares], list[MPC_BitShares]]]) -> list[tuple[MPC_BitShares, MPC_BitShares, MPC_BitShares]]:
+        results = []
+        for x, y in pairs:
+            shape = np.broadcast_shapes(x[0].shape, y[0].shape)
+            z = [x[p].LocalAnd(y[p], self.zero_sharings[p].NextBits(shape)) for p in range(3)]
+            results.append(self.mpc_bits.BitResharing(*z, x[0].nbits))
+            self.bits_sent += int(np.prod(shape[:-1])) * x[0].nbits
+        self.rounds += 1
+        return results
+
+    # Sum s + t (mod 2^nbits) of shared nbits-bit numbers (one per word), with a
+    # Kogge-Stone prefix over the carries: G = s & t, P = s ^ t and
+    # G = G ^ (P & (G << d)), P = P & (P << d) for d = 1, 2, 4, ... (1 + log2(nbits) rounds)
+    def Add(self, s: list[MPC_BitShares], t: list[MPC_BitShares]) -> list[MPC_BitShares]:
+        nbits = s[0].nbits
+        P0 = [s[p].LocalXor(t[p]) for p in range(3)]
+        (G,) = self.AndRound([(s, t)])
+        P = P0
+        distance = 1
+        while distance < nbits - 1:
+            shifted = [shift_bits(G[p], distance) for p in range(3)]
+            if 2 * distance < nbits - 1:
+                G_and, P = self.AndRound([(P, shifted), (P, [shift_bits(P[p], distance) for p in range(3)])])
+            else:
+                (G_and,) = self.AndRound([(P, shifted)])
+            G = [G[p].LocalXor(G_and[p]) for p in range(3)]
+            distance *= 2
+
+        # Sum bits = P0 ^ carries
+        return [P0[p].LocalXor(shift_bits(G[p], 1)) for p in range(3)]
+
+    # Number of set bits of every row of shared packed bits, as shared count_bits-bit
+    # numbers (one per word, mod 2^count_bits). The words of weight 2^w are compressed
+    # 3 to 2 by full adders (sum a ^ b ^ c of weight 2^w, carry maj(a, b, c) of weight
+    # 2^(w+1)), all the weights in the same round, until every weight has at most 2
+    # words. The lanes of the words are then folded in halves (locally) and compressed
+    # again, down to one lane, and the 2 remaining numbers are added
+    def PopCount(self, x: list[MPC_BitShares], count_bits: int) -> list[MPC_BitShares]:
+        columns = {0: x}
+        lanes = WORD_BITS
+        while True:
+            while any(c[0].shape[-1] > 2 for c in columns.values()):
+                pairs, plan = [], []
+                for w, c in columns.items():
+                    triples = c[0].shape[-1] // 3
+                    if triples == 0:
+                        continue
+                    a, b, d = ([select_words(c[p], slice(i, 3 * triples, 3)) for p in range(3)] for i in range(3))
+                    pairs.append(([a[p].LocalXor(d[p]) for p in range(3)], [b[p].LocalXor(d[p]) for p in range(3)]))
+                    plan.append((w, a, b, d, [select_words(c[p], slice(3 * triples, None)) for p in range(3)]))
+
+                # maj(a, b, d) = ((a ^ d) & (b ^ d)) ^ d
+                new_columns = {w: [[c[p]] for p in range(3)] for w, c in columns.items()}
+                for w, _, _, _, _ in plan:
+                    new_columns[w] = [[] for _ in range(3)]
+                for (w, a, b, d, rest), carry in zip(plan, self.AndRound(pairs)):
+                    for p in range(3):
+                        new_columns[w][p] += [a[p].LocalXor(b[p]).LocalXor(d[p]), rest[p]]
+                        if w + 1 < count_bits:
+                            new_columns.setdefault(w + 1, [[] for _ in range(3)])[p].append(carry[p].LocalXor(d[p]))
+                columns = {
+                    w: [concatenate_words(c[p]) for p in range(3)]
+                    for w, c in sorted(new_columns.items())
+                }
+            if lanes == 1:
+                break
+
+            # Fold the high half of the lanes onto the low half
+            lanes //= 2
+            columns = {
+                w: [concatenate_words([fold_bits(c[p], 0, lanes), fold_bits(c[p], lanes, lanes)]) for p in range(3)]
+                for w, c in columns.items()
+            }
+
+        # The 2 numbers whose bit w is the lane 0 of the first and of the second word of weight 2^w
+        one = np.uint64(1)
+        numbers = []
+        for word in range(2):
+            number = []
+            for p in range(3):
+                bits_i = np.zeros(x[p].shape[:-1] + (1,), dtype=np.uint64)
+                bits_j = np.zeros_like(bits_i)
+                for w, c in columns.items():
+                    if c[p].shape[-1] > word:
+                        bits_i |= (c[p].bits_i[..., word:word + 1] & one) << np.uint64(w)
+                        bits_j |= (c[p].bits_j[..., word:word + 1] & one) << np.uint64(w)
+                number.append(MPC_BitShares(bits_i, bits_j, p, count_bits))
+            numbers.append(number)
+        return self.Add(*numbers)
+
+    # Arithmetic shares (ring of `order`) of shared nbits-bit numbers (one per word),
+    # from nbits daBits per number: the numbers masked with rho are opened (1 round)
+    def ToArithmetic(self, x: list[MPC_BitShares]) -> list[MPC_ArrayShares]:
+        nbits = x[0].nbits
+        rho_bits, rho_ring = self.dealer.DaBits(x[0].shape[:-1], nbits)
+        c = self.mpc_bits.OpenBits(*[x[p].LocalXor(rho_bits[p]) for p in range(3)])
+        self.rounds += 1
+        self.bits_sent += int(np.prod(x[0].shape[:-1])) * nbits
+        return [x[p].LocalValue(c, rho_ring[p]) for p in range(3)]
+##########################################################################################
+
+# Split a gallery of codes and masks (rows of bits) into the packed shares of the 3 parties
+def split_bit_gallery(mpc_bits: MPC_Bits, codes: np.ndarray, masks: np.ndarray) -> list[tuple[MPC_BitShares, MPC_BitShares]]:
+    return list(zip(mpc_bits.SplitBits(codes), mpc_bits.SplitBits(masks)))
+
+# 1:N search over packed bits. Returns the masked dot products of the query against
+# every gallery row (equal to the ones of the ring protocol on mask_bits codes).
+# `preprocessing` is a preprocessing.Preprocessor providing the daBits (or None)
+def bitsliced_match(mpc_bits: MPC_Bits, query, galleries, zero_sharings, preprocessing=None) -> np.ndarray:
+    query_codes, query_masks = zip(*query)
+    gallery_codes, gallery_masks = zip(*galleries)
+    num_codes, nbits = len(gallery_codes[0]), gallery_codes[0].nbits
+
+    circuit = BooleanCircuit(mpc_bits, zero_sharings, preprocessing)
+    k = int(mpc_bits.mpc.k)
+
+    # Disagreements (local) and mask overlap (one AND round)
+    d = [query_codes[p].LocalXor(gallery_codes[p]) for p in range(3)]
+    (m,) = circuit.AndRound([(query_masks, gallery_masks)])
+
+    # Masked disagreements (one AND round)
+    (md,) = circuit.AndRound([(m, d)])
+
+    # Both counts in one adder tree (the rows of m, then those of m & d), converted
+    # to arithmetic shares as k-bit numbers
+    x = [MPC_BitShares(np.concatenate([m[p].bits_i, md[p].bits_i]), np.concatenate([m[p].bits_j, md[p].bits_j]), p, nbits) for p in range(3)]
+    counts = circuit.ToArithmetic(circuit.PopCount(x, k))
+
+    # Scores |m| - 2 |m & d|, then opened
+    scores = [counts[p][:num_codes].LocalSubtraction(counts[p][num_codes:].LocalScale(2)) for p in range(3)]
+    return mpc_bits.mpc.ReconstructArraySecret(scores[0], scores[1])
+
+def bitsliced_test(num_codes: int = 200, vector_length: int = 12800, k: int = 16):
+    mpc = MPC(k)
+    mpc_bits = MPC_Bits(mpc)
+    codes_db, masks_db = np.random.randint(0, 2, (2, num_codes, vector_length))
+    code_query, mask_query = np.random.randint(0, 2, (2, vector_length))
+
+    galleries = split_bit_gallery(mpc_bits, codes_db, masks_db)
+    query = list(zip(mpc_bits.SplitBits(code_query), mpc_bits.SplitBits(mask_query)))
+    scores = bitsliced_match(mpc_bits, query, galleries, setup_zero_sharing(k))
+
+    reference = mask_bits(codes_db, masks_db) @ mask_bits(code_query, mask_query)
+    assert np.array_equal(signed_integer(scores, k), reference), "Exception: Wrong scores."
+    ring_bytes = 2 * num_codes * vector_length * ring_dtype(k).itemsize
+    print(f"Scores match the reference, gallery shares: {galleries[0][0].nbytes + galleries[0][1].nbytes} bytes per party (ring: {ring_bytes} bytes)")
+
+if __name__ == "__main__":
+    bitsliced_test()
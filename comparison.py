@@ -0,0 +1,126 @@
+# Secure comparison of secret-shared ring elements, batched over whole vectors.
+# The sign (most significant bit) of x = x_1 + x_2 + x_3 (mod 2^k) is extracted with a
+# boolean circuit over XOR-shares where every k-bit element sits in one uint64 word,
+# so the AND gates of all the bits and all the elements of a round are evaluated
+# with one word operation each:
+#   - every component x_c is known to 2 parties, so its XOR-sharing is free
+#   - a carry-save adder turns x_1 + x_2 + x_3 into s + t (1 round)
+#   - a Kogge-Stone prefix computes the carries of s + t: G = s & t, P = s ^ t and
+#     G = G ^ (P & (G << d)), P = P & (P << d) for d = 1, 2, 4, ... (1 + log2(k) rounds)
+# The number of rounds depends on k only, never on the number of elements.
+from __future__ import annotations
+from fractions import Fraction
+import numpy as np
+from MPC import MPC, MPC_ArrayShares
+from bitsliced import BooleanCircuit, MPC_BitShares, MPC_Bits, select_bit, shift_bits
+from correlated import setup_zero_sharing
+from gallery import split_fused_gallery
+from utils import mask_bits
+
+# Largest scale of the integer threshold test (the match ratio is taken as the nearest
+# fraction with at most this denominator, e.g. exactly 1/1000 for 0.001)
+MAX_THRESHOLD_SCALE = 10**6
+
+# Shares of the component c of shared ring elements as XOR-shares held by this party
+# (one element per word, all the other components set to zero)
+def component_bits(shares: MPC_ArrayShares, c: int) -> MPC_BitShares:
+    p = shares.party
+    zeros = np.zeros(shares.shape + (1,), dtype=np.uint64)
+    share_i = shares.share_i.astype(np.uint64)[..., None] if c == p else zeros
+    share_j = shares.share_j.astype(np.uint64)[..., None] if c == (p - 1) % 3 else zeros.copy()
+    return MPC_BitShares(share_i, share_j, p, shares.k)
+
+# Class to handle the batched secure comparisons of the 3 parties
+class SecureComparison(BooleanCircuit):
+    # Shares of the sign bit of the shared elements (1 for the elements >= 2^(k-1),
+    # that is the negative ones as signed integers)
+    def Msb(self, shares: list[MPC_ArrayShares]) -> list[MPC_BitShares]:
+        k = shares[0].k
+        a, b, c = ([component_bits(shares[p], comp) for p in range(3)] for comp in range(3))
+
+        # Carry-save adder: a + b + c = (a ^ b ^ c) + 2 maj(a, b, c),
+        # with maj(a, b, c) = ((a ^ c) & (b ^ c)) ^ c
+        s = [a[p].LocalXor(b[p]).LocalXor(c[p]) for p in range(3)]
+        (carry,) = self.AndRound([([a[p].LocalXor(c[p]) for p in range(3)], [b[p].LocalXor(c[p]) for p in range(3)])])
+        t = [shift_bits(carry[p].LocalXor(c[p]), 1) for p in range(3)]
+
+        # Kogge-Stone addition s + t, of which only the bit k-1 is kept
+        return [select_bit(total, k - 1) for total in self.Add(s, t)]
+
+    # Shares of the bits x < y (for |x - y| < 2^(k-1))
+    def LessThan(self, x: list[MPC_ArrayShares], y: list[MPC_ArrayShares]) -> list[MPC_BitShares]:
+        return self.Msb([x[p].LocalSubtraction(y[p]) for p in range(3)])
+
+    # Arithmetic shares (ring of `order`) of shared bits (one per word), from daBits:
+    # the bits masked with rho are opened and b = c + rho - 2 c rho locally (1 round)
+    def BitToArithmetic(self, bits: list[MPC_BitShares]) -> list[MPC_ArrayShares]:
+        return self.ToArithmetic(bits)
+
+    # Open the shared bits to everyone (the only values revealed by a comparison)
+    def OpenBits(self, bits: list[MPC_BitShares]) -> np.ndarray:
+        return self.mpc_bits.ReconstructBits(bits[0], bits[1])[..., 0].astype(bool)
+
+# Exact integer coefficients (scale, threshold) of the test dp > (1 - 2 ratio) |m|,
+# that is scale * dp > threshold * |m| with threshold / scale = 1 - 2 ratio
+def threshold_coefficients(match_ratio: float, max_scale: int = MAX_THRESHOLD_SCALE) -> tuple[int, int]:
+    coefficient = 1 - 2 * Fraction(match_ratio).limit_denominator(max_scale)
+    return coefficient.denominator, coefficient.numerator
+
+# Match bits of shared scores against the shared mask overlaps, without revealing
+# either: match iff scale * dp - threshold * |m| > 0, i.e. threshold * |m| - scale * dp < 0.
+# With |dp| <= |m| <= vector_length the difference must not wrap around the ring
+def secure_threshold(
+    comparison: SecureComparison, scores: list[MPC_ArrayShares], overlaps: list[MPC_ArrayShares], match_ratio: float,
+    vector_length: int,
+) -> np.ndarray:
+    scale, threshold = threshold_coefficients(match_ratio)
+    assert (scale + abs(threshold)) * vector_length < 2**(scores[0].k - 1), "Exception: The ring is too small for the threshold test."
+    differences = [overlaps[p].LocalScale(threshold).LocalSubtraction(scores[p].LocalScale(scale)) for p in range(3)]
+    return comparison.OpenBits(comparison.Msb(differences))
+##########################################################################################
+
+def comparison_test(num_values: int = 10000, k: int = 32):
+    mpc = MPC(k)
+    comparison = SecureComparison(MPC_Bits(mpc), setup_zero_sharing(k))
+    values = np.random.randint(-2**(k - 2), 2**(k - 2), num_values, dtype=np.int64)
+    values[:2] = [0, -1]
+
+    bits = comparison.OpenBits(comparison.Msb(list(mpc.SplitArraySecret(values))))
+    assert np.array_equal(bits, values < 0), "Exception: Wrong sign bits."
+    print(f"Sign bits of {num_values} values in {comparison.rounds} rounds, {comparison.bits_sent} bits sent per party")
+
+# 1:N search where only the match bits are opened: the scores and the mask overlaps
+# stay shared, and the thresholds are applied on shares
+def secure_match_test(num_codes: int = 500, vector_length: int = 10000, match_index: int = 100, match_ratio: float = 0.01, k: int = 32):
+    mpc = MPC(k)
+    zero_sharings = setup_zero_sharing(k)
+    comparison = SecureComparison(MPC_Bits(mpc), zero_sharings)
+
+    codes_db, masks_db = np.random.randint(0, 2, (2, num_codes, vector_length))
+    code_query, mask_query = codes_db[match_index], np.random.randint(0, 2, vector_length)
+
+    # Gallery rows of masked code and mask, and the shares of the query
+    galleries = split_fused_gallery(mpc, mask_bits(codes_db, masks_db), masks_db)
+    code_query_shares = mpc.SplitArraySecret(mask_bits(code_query, mask_query))
+    mask_query_shares = mpc.SplitArraySecret(mask_query)
+
+    # Scores and mask overlaps in one pass over the gallery, re-randomized and reshared in one round
+    z = [
+        galleries[p].LocalMatchSegments([code_query_shares[p], mask_query_shares[p]], r=zero_sharings[p].Next((2, num_codes)))
+        for p in range(3)
+    ]
+    scores = mpc.ArrayResharing(*[z_p[0] for z_p in z])
+    overlaps = mpc.ArrayResharing(*[z_p[1] for z_p in z])
+
+    matches = secure_threshold(comparison, scores, overlaps, match_ratio, vector_length)
+
+    # Reference in the clear
+    dp_real = mask_bits(codes_db, masks_db) @ mask_bits(code_query, mask_query)
+    scale, threshold = threshold_coefficients(match_ratio)
+    reference = scale * dp_real > threshold * (masks_db & mask_query).sum(axis=1)
+    assert np.array_equal(matches, reference), "Exception: Wrong match bits."
+    print(f"Matches: {np.flatnonzero(matches).tolist()} ({comparison.rounds + 1} rounds)")
+
+if __name__ == "__main__":
+    comparison_test()
+    secure_match_test()
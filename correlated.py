@@ -0,0 +1,57 @@
+# Correlated randomness from pairwise PRF keys.
+# Party p (0, 1, 2 for P1, P2, P3) holds the key K_p, shared with party p+1, and the
+# key K_{p-1}, shared with party p-1. Every key is set up once (party p draws K_p and
+# sends it to party p+1); afterwards the parties derive zero-sharings locally by counter:
+#   r_p = F(K_p, c) - F(K_{p-1}, c),  so that  r_1 + r_2 + r_3 = 0 (mod 2^k)
+# These re-randomize the single shares of products and dot products before Resharing
+# at no cost in communication or fresh random bytes
+from __future__ import annotations
+import os
+import numpy as np
+from prg import PRG, SEED_BYTES
+from ring import ring_reduce
+
+# Bit set in the PRF counters of the boolean zero-sharings (domain separation)
+BOOLEAN_DOMAIN = 1 << 62
+
+# Class to handle the zero-sharings derived by one party
+class ZeroSharing:
+    def __init__(self, party: int, key_own: bytes, key_prev: bytes, k: int) -> ZeroSharing:
+        assert party in (0, 1, 2), "Exception: The party id must be 0, 1 or 2."
+        self.party = party
+        self.k = int(k)
+        self.prf_own = PRG(key_own)
+        self.prf_prev = PRG(key_prev)
+
+        # Counter of the next zero-sharing (must advance equally in the 3 parties)
+        self.counter = 0
+
+    # Derive this party's shares of zero for `shape` values from an explicit counter
+    # (e.g. a query id, so that pipelined queries can be processed in any order)
+    def Derive(self, counter: int, shape) -> np.ndarray:
+        r = self.prf_own.ExpandRing(counter, shape, self.k) - self.prf_prev.ExpandRing(counter, shape, self.k)
+        return ring_reduce(r, self.k)
+
+    # Derive this party's XOR-shares of zero for `shape` 64-bit words (boolean sharing).
+    # The counters are kept apart from the ones of the arithmetic zero-sharings
+    def DeriveBits(self, counter: int, shape) -> np.ndarray:
+        counter = counter | BOOLEAN_DOMAIN
+        return self.prf_own.ExpandRing(counter, shape, 64) ^ self.prf_prev.ExpandRing(counter, shape, 64)
+
+    # Derive this party's XOR-shares of zero for the next `shape` 64-bit words
+    def NextBits(self, shape) -> np.ndarray:
+        r = self.DeriveBits(self.counter, shape)
+        self.counter += 1
+        return r
+
+    # Derive this party's shares of zero for the next `shape` values
+    def Next(self, shape) -> np.ndarray:
+        r = self.Derive(self.counter, shape)
+        self.counter += 1
+        return r
+
+# Set up the pairwise keys of the 3 parties (each key is known to 2 parties only)
+def setup_zero_sharing(k: int, keys: list[bytes] = None) -> tuple[ZeroSharing, ZeroSharing, ZeroSharing]:
+    if keys is None:
+        keys = [os.urandom(SEED_BYTES) for _ in range(3)]
+    return tuple(ZeroSharing(p, keys[p], keys[(p - 1) % 3], k) for p in range(3))
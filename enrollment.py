@@ -0,0 +1,135 @@
+# Streaming enrollment of plaintext galleries larger than RAM.
+# The codes and masks are read in chunks of rows from .npy files (memory-mapped), every
+# chunk is masked, split with the vectorized sharer and appended to the 3 parties'
+# on-disk galleries, which grow in place. Only one chunk is held in memory at a time,
+# so the memory used does not depend on the size of the gallery.
+#   python enrollment.py codes.npy masks.npy party0 party1 party2
+from __future__ import annotations
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from MPC import MPC
+from gallery import SharedGallery, enroll_codes
+from utils import mask_bits, signed_integer
+
+# Rows read, split and appended per chunk
+ENROLL_CHUNK_ROWS = 1024
+
+# Anonymous (non file-backed) resident memory of this process in kB, or None if unknown.
+# The pages of the memory-mapped galleries are page cache and not counted here
+def anonymous_rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+# Chunks (codes, masks) of the rows of 2 .npy files
+def read_chunks(codes_path: str, masks_path: str, chunk_rows: int = ENROLL_CHUNK_ROWS):
+    codes = np.load(codes_path, mmap_mode="r")
+    masks = np.load(masks_path, mmap_mode="r")
+    assert codes.shape == masks.shape and codes.ndim == 2, "Exception: The codes and masks must be matrices of the same shape."
+    for start in range(0, codes.shape[0], chunk_rows):
+        yield np.asarray(codes[start:start + chunk_rows]), np.asarray(masks[start:start + chunk_rows])
+
+# Open the 3 parties' galleries for writing, creating them with the first chunk of
+# shares if none of them exists yet. Some of them only would leave the parties'
+# galleries out of sync, so it is an error
+def open_galleries(mpc: MPC, gallery_paths: list[str], first_codes: np.ndarray) -> tuple[list[SharedGallery], bool]:
+    existing = [os.path.exists(path) for path in gallery_paths]
+    assert all(existing) or not any(existing), "Exception: Only some of the parties' galleries exist."
+    created = not any(existing)
+    if created:
+        for path, shares in zip(gallery_paths, mpc.SplitArraySecret(first_codes)):
+            SharedGallery(shares).Save(path)
+    return [SharedGallery.Open(path, mode="r+") for path in gallery_paths], created
+
+# Enroll a stream of (codes, masks) chunks into the 3 parties' galleries on disk.
+# Yields after every chunk the number of rows enrolled so far
+def enroll_stream(mpc: MPC, chunks, gallery_paths: list[str]):
+    galleries = None
+    enrolled = 0
+    for codes, masks in chunks:
+        # Signed values, so that the masked -1 does not wrap in the (uint8) dtype of the files
+        masked_codes = mask_bits(codes.astype(np.int8), masks.astype(np.int8))
+        if galleries is None:
+            galleries, created = open_galleries(mpc, gallery_paths, masked_codes)
+            if not created:
+                enroll_codes(mpc, galleries, masked_codes)
+        else:
+            enroll_codes(mpc, galleries, masked_codes)
+        for gallery in galleries:
+            gallery.Flush()
+        enrolled += len(masked_codes)
+        yield enrolled
+
+# Enroll the codes and masks of 2 .npy files, reporting the throughput
+def enroll_files(
+    mpc: MPC, codes_path: str, masks_path: str, gallery_paths: list[str], chunk_rows: int = ENROLL_CHUNK_ROWS, verbose: bool = True
+) -> dict:
+    start = time.perf_counter()
+    rows, peak_anonymous = 0, 0
+    for rows in enroll_stream(mpc, read_chunks(codes_path, masks_path, chunk_rows), gallery_paths):
+        peak_anonymous = max(peak_anonymous, anonymous_rss_kb() or 0)
+        if verbose:
+            elapsed = time.perf_counter() - start
+            print(f"\r{rows} rows, {rows / elapsed:.0f} rows/s, anonymous RSS {peak_anonymous} kB", end="", flush=True)
+    elapsed = time.perf_counter() - start
+    if verbose:
+        print()
+    return {"rows": rows, "seconds": elapsed, "rows_per_s": rows / elapsed if elapsed > 0 else 0.0, "peak_anonymous_rss_kb": peak_anonymous}
+
+# Write random codes and masks to .npy files, one chunk at a time (test data)
+def write_random_codes(codes_path: str, masks_path: str, num_codes: int, vector_length: int, chunk_rows: int = ENROLL_CHUNK_ROWS) -> None:
+    for path in (codes_path, masks_path):
+        array = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(num_codes, vector_length))
+        for start in range(0, num_codes, chunk_rows):
+            stop = min(start + chunk_rows, num_codes)
+            array[start:stop] = np.random.randint(0, 2, (stop - start, vector_length))
+        array.flush()
+        del array
+##########################################################################################
+
+def enrollment_test(num_codes: int = 20000, vector_length: int = 2000, chunk_rows: int = 1000, k: int = 16):
+    mpc = MPC(k)
+    directory = tempfile.mkdtemp()
+    codes_path, masks_path = os.path.join(directory, "codes.npy"), os.path.join(directory, "masks.npy")
+    gallery_paths = [os.path.join(directory, f"party{p}") for p in range(3)]
+    write_random_codes(codes_path, masks_path, num_codes, vector_length, chunk_rows)
+
+    # Two enrollments into the same galleries (the second one appends)
+    stats = enroll_files(mpc, codes_path, masks_path, gallery_paths, chunk_rows)
+    stats = enroll_files(mpc, codes_path, masks_path, gallery_paths, chunk_rows)
+    print(stats)
+
+    # Check a sample of rows against the plaintext files
+    galleries = [SharedGallery.Open(path) for path in gallery_paths]
+    assert all(gallery.num_codes == 2 * num_codes for gallery in galleries), "Exception: Wrong number of rows."
+    rows = np.random.choice(2 * num_codes, 100, replace=False)
+    codes, masks = np.load(codes_path, mmap_mode="r"), np.load(masks_path, mmap_mode="r")
+    expected = mask_bits(codes[rows % num_codes].astype(np.int64), masks[rows % num_codes].astype(np.int64))
+    recovered = mpc.ReconstructArraySecret(galleries[0].shares[rows], galleries[1].shares[rows])
+    assert np.array_equal(signed_integer(recovered, k), expected), "Exception: Wrong enrolled shares."
+    assert np.array_equal(galleries[0].row_ids, np.arange(2 * num_codes)), "Exception: Wrong row ids."
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming enrollment of plaintext codes into the 3 parties' galleries")
+    parser.add_argument("codes", help=".npy file of the codes (rows of 0/1)")
+    parser.add_argument("masks", help=".npy file of the masks (rows of 0/1)")
+    parser.add_argument("galleries", nargs=3, help="gallery directories of the 3 parties (created or appended to)")
+    parser.add_argument("--chunk-rows", type=int, default=ENROLL_CHUNK_ROWS, help="rows per chunk")
+    parser.add_argument("-k", type=int, default=16, help="bits of the ring")
+    args = parser.parse_args()
+    print(enroll_files(MPC(args.k), args.codes, args.masks, args.galleries, args.chunk_rows))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main()
+    else:
+        enrollment_test()
@@ -0,0 +1,145 @@
+# Fixed-point arithmetic on top of the ring shares: a real x is encoded as the ring
+# element round(x * 2^f) (two's complement for the negative values), with f fractional
+# bits. Additions and public integer scalings are the ring ones; the product of two
+# encodings carries 2f fractional bits and is truncated back to f bits with the
+# probabilistic truncation of ABY3 (dealer pairs r, r' = r / 2^f):
+#   the parties open c = z - r from their single shares z_p of the product, and
+#   [z / 2^f] = c / 2^f + [r']
+# which is exact up to 1 in the last fractional bit, and fails with probability
+# about 2^(l + 1 - k) for products of l bits (k = 64 leaves ample room).
+from __future__ import annotations
+import numpy as np
+from MPC import MPC, MPC_ArrayShares
+from comparison import SecureComparison
+from correlated import ZeroSharing, setup_zero_sharing
+from bitsliced import MPC_Bits
+from gallery import split_fused_gallery
+from ring import ring_reduce, to_ring
+from utils import mask_bits, signed_integer
+
+# Default number of fractional bits
+FRAC_BITS = 12
+
+# Class to handle fixed-point values shared with an MPC instance
+class FixedPoint:
+    def __init__(self, mpc: MPC, frac_bits: int = FRAC_BITS, preprocessing=None) -> FixedPoint:
+        self.mpc = mpc
+        self.k = int(mpc.k)
+        self.frac_bits = frac_bits
+        assert 0 < frac_bits < self.k - 1, "Exception: The fractional bits must leave room for the integer part."
+        self.scale = 2**frac_bits
+
+        # Source of the truncation pairs: a preprocessing.Preprocessor, or the dealer inline
+        self.dealer = preprocessing if preprocessing is not None else self
+
+        # Number of truncations performed (each one opens one ring element per value)
+        self.truncations = 0
+
+    # Encode real values as ring elements with frac_bits fractional bits
+    def Encode(self, values) -> np.ndarray:
+        return to_ring(np.round(np.asarray(values, dtype=np.float64) * self.scale).astype(np.int64), self.k)
+
+    # Decode ring elements into real values
+    def Decode(self, values) -> np.ndarray:
+        return signed_integer(np.asarray(values), self.k) / self.scale
+
+    def SplitFixed(self, values) -> tuple[MPC_ArrayShares, MPC_ArrayShares, MPC_ArrayShares]:
+        return self.mpc.SplitArraySecret(self.Encode(values))
+
+    def ReconstructFixed(self, sharesA: MPC_ArrayShares, sharesB: MPC_ArrayShares) -> np.ndarray:
+        return self.Decode(self.mpc.ReconstructArraySecret(sharesA, sharesB))
+
+    # Dealer truncation pairs: shares of a random r and of r' = r >> f (arithmetic shift)
+    def TruncationPairs(self, shape) -> tuple[tuple, tuple]:
+        r = self.mpc.prg.RandomRing(shape, self.k)
+        r_truncated = to_ring(signed_integer(r, self.k) >> self.frac_bits, self.k)
+        return self.mpc.SplitArraySecret(r), self.mpc.SplitArraySecret(r_truncated)
+
+    # Truncate by 2^f the values given as single (3-out-of-3) shares z_1, z_2, z_3,
+    # returning their replicated shares. Party p reveals z_p - r_p, the opened
+    # value c = z - r hides z behind the random r
+    def Truncate(self, z1: np.ndarray, z2: np.ndarray, z3: np.ndarray) -> tuple[MPC_ArrayShares, MPC_ArrayShares, MPC_ArrayShares]:
+        r, r_truncated = self.dealer.TruncationPairs(np.shape(z1))
+        masked = [ring_reduce(z - r[p].share_i, self.k) for p, z in enumerate((z1, z2, z3))]
+        c = ring_reduce(masked[0] + masked[1] + masked[2], self.k)
+        self.truncations += 1
+
+        c_truncated = signed_integer(c, self.k) >> self.frac_bits
+        return tuple(r_truncated[p].LocalAddPublic(c_truncated) for p in range(3))
+
+    # Product of 2 shared fixed-point arrays (element-wise): local multiplication,
+    # re-randomization with a zero-sharing and truncation
+    def Multiply(
+        self, x: list[MPC_ArrayShares], y: list[MPC_ArrayShares], zero_sharings: tuple[ZeroSharing, ZeroSharing, ZeroSharing]
+    ) -> tuple[MPC_ArrayShares, MPC_ArrayShares, MPC_ArrayShares]:
+        z = [x[p].LocalMultiplication(y[p], r=zero_sharings[p].Next(x[p].shape)) for p in range(3)]
+        return self.Truncate(*z)
+
+    # Product of a shared fixed-point array by a public real constant. Component p of
+    # the replicated shares is a valid single share, so no zero-sharing is needed
+    def MultiplyPublic(self, x: list[MPC_ArrayShares], constant: float) -> tuple[MPC_ArrayShares, MPC_ArrayShares, MPC_ArrayShares]:
+        z = [x[p].LocalScale(self.Encode(constant)).share_i for p in range(3)]
+        return self.Truncate(*z)
+
+# Match bits of the shared integer scores against the fractional thresholds
+# (1 - 2 ratio) |m| of the shared integer mask overlaps, compared at f fractional
+# bits: both sides are integers times a fixed-point constant, so no truncation is needed.
+# With |dp| <= |m| <= vector_length the difference must not wrap around the ring
+def fixed_threshold(
+    comparison: SecureComparison, fixed: FixedPoint, scores: list[MPC_ArrayShares], overlaps: list[MPC_ArrayShares], match_ratio: float,
+    vector_length: int,
+) -> np.ndarray:
+    coefficient = int(np.round((1 - 2 * match_ratio) * fixed.scale))
+    assert (fixed.scale + abs(coefficient)) * vector_length < 2**(fixed.k - 1), "Exception: The ring is too small for the threshold test."
+    thresholds = [overlaps[p].LocalScale(fixed.Encode(1 - 2 * match_ratio)) for p in range(3)]
+    differences = [thresholds[p].LocalSubtraction(scores[p].LocalScale(fixed.scale)) for p in range(3)]
+    return comparison.OpenBits(comparison.Msb(differences))
+##########################################################################################
+
+def fixed_point_test(num_values: int = 10000, k: int = 64):
+    mpc = MPC(k)
+    fixed = FixedPoint(mpc)
+    zero_sharings = setup_zero_sharing(k)
+    x, y = np.random.uniform(-1000, 1000, (2, num_values))
+
+    products = fixed.Multiply(fixed.SplitFixed(x), fixed.SplitFixed(y), zero_sharings)
+    scaled = fixed.MultiplyPublic(products, 0.25)
+    result = fixed.ReconstructFixed(scaled[0], scaled[1])
+
+    # Each encoding and each truncation is off by at most one unit in the last place
+    error = np.abs(result - 0.25 * x * y)
+    tolerance = (0.25 * (np.abs(x) + np.abs(y)) + 3) / fixed.scale
+    assert np.all(error <= tolerance), "Exception: Wrong fixed-point products."
+    print(f"Fixed-point products of {num_values} values, max error {error.max():.2e}")
+
+def fixed_threshold_test(num_codes: int = 500, vector_length: int = 10000, match_index: int = 100, match_ratio: float = 0.01, k: int = 32):
+    mpc = MPC(k)
+    zero_sharings = setup_zero_sharing(k)
+    comparison = SecureComparison(MPC_Bits(mpc), zero_sharings)
+    fixed = FixedPoint(mpc)
+
+    codes_db, masks_db = np.random.randint(0, 2, (2, num_codes, vector_length))
+    code_query, mask_query = codes_db[match_index], np.random.randint(0, 2, vector_length)
+    galleries = split_fused_gallery(mpc, mask_bits(codes_db, masks_db), masks_db)
+    code_query_shares = mpc.SplitArraySecret(mask_bits(code_query, mask_query))
+    mask_query_shares = mpc.SplitArraySecret(mask_query)
+
+    z = [
+        galleries[p].LocalMatchSegments([code_query_shares[p], mask_query_shares[p]], r=zero_sharings[p].Next((2, num_codes)))
+        for p in range(3)
+    ]
+    scores = mpc.ArrayResharing(*[z_p[0] for z_p in z])
+    overlaps = mpc.ArrayResharing(*[z_p[1] for z_p in z])
+    matches = fixed_threshold(comparison, fixed, scores, overlaps, match_ratio, vector_length)
+
+    # Reference: the float threshold of main_protocol (the scaled constant is exact
+    # to 2^-f, which only matters within |m| 2^-f of the threshold)
+    dp_real = mask_bits(codes_db, masks_db) @ mask_bits(code_query, mask_query)
+    thresholds = (1 - 2 * match_ratio) * (masks_db & mask_query).sum(axis=1)
+    clear = np.abs(dp_real - thresholds) > vector_length / fixed.scale
+    assert np.array_equal(matches[clear], (dp_real > thresholds)[clear]), "Exception: Wrong match bits."
+    print(f"Matches: {np.flatnonzero(matches).tolist()}")
+
+if __name__ == "__main__":
+    fixed_point_test()
+    fixed_threshold_test()
@@ -0,0 +1,528 @@
+# Secret-shared gallery (database of codes) and the 1:N matching engine.
+# Each party holds the gallery as a share matrix of shape (num_codes, vector_length)
+from __future__ import annotations
+import json
+import os
+import threading
+import numpy as np
+from MPC import MPC, MPC_ArrayShares
+from ring import BLOCK_ELEMENTS, ring_reduce, ring_matvec, to_ring
+
+# On-disk format of a party's gallery: a directory with the metadata in JSON and
+# the two share matrices and the row ids as raw arrays opened with numpy.memmap.
+# The matrices are allocated for `capacity` rows of which the first `num_codes` are used
+GALLERY_FORMAT = 1
+META_FILE = "meta.json"
+SHARE_I_FILE = "share_i.bin"
+SHARE_J_FILE = "share_j.bin"
+ROW_IDS_FILE = "row_ids.bin"
+
+# Growth of the share matrices when enrolling (amortized, never below one chunk)
+GROWTH_FACTOR = 1.5
+MIN_CHUNK_ROWS = 1024
+
+# Row id of a tombstoned (deleted) gallery row
+DELETED_ID = -1
+
+# Class to handle the share matrices of the gallery held by one party
+class SharedGallery:
+    def __init__(self, shares: MPC_ArrayShares, row_ids: np.ndarray = None) -> SharedGallery:
+
+        # Check that the shares are a matrix
+        assert len(shares.shape) == 2, "Exception: The gallery shares must be a matrix."
+
+        # Identifiers of the gallery rows (by default their position)
+        if row_ids is None:
+            row_ids = np.arange(shares.shape[0], dtype=np.int64)
+        assert len(row_ids) == shares.shape[0], "Exception: There must be one row id per gallery code."
+
+        # Storage of the share matrices and row ids. They can be allocated for more
+        # rows than used (capacity) so that enrollments are amortized
+        self._share_i = shares.share_i
+        self._share_j = shares.share_j
+        self._row_ids = np.asarray(row_ids, dtype=np.int64)
+        self._count = shares.shape[0]
+        self._lock = threading.RLock()
+        self._compaction = None
+        self.path = None
+
+        # Number of metadata updates of the gallery on disk (changes whenever the
+        # files are grown, compacted or appended to)
+        self.generation = 0
+
+        # Precomputed g_i + g_j operand of the replicated product (None until enabled)
+        self._operand_sum = None
+
+        self.party = shares.party
+        self.order = shares.order
+        self.k = shares.k
+
+        # Next row id to assign (the deleted rows are tombstoned in the row ids)
+        self.next_row_id = int(self._row_ids.max()) + 1 if self._count > 0 else 0
+
+    # Shares of the used rows of the gallery (including tombstoned rows)
+    @property
+    def shares(self) -> MPC_ArrayShares:
+        return MPC_ArrayShares(
+            self._share_i[:self._count], self._share_j[:self._count], self.party, self.order
+        )
+
+    # Row ids of the used rows of the gallery (DELETED_ID for tombstoned rows)
+    @property
+    def row_ids(self) -> np.ndarray:
+        return self._row_ids[:self._count]
+
+    @property
+    def num_codes(self) -> int:
+        return self._count
+
+    @property
+    def capacity(self) -> int:
+        return self._share_i.shape[0]
+
+    @property
+    def vector_length(self) -> int:
+        return self._share_i.shape[1]
+
+    @property
+    def precomputed(self) -> bool:
+        return self._operand_sum is not None
+
+    # Bytes of the share matrices and of the precomputed operand (allocated storage)
+    def MemoryUsage(self) -> dict:
+        shares = self._share_i.nbytes + self._share_j.nbytes
+        precomputed = self._operand_sum.nbytes if self.precomputed else 0
+        return {"shares": shares, "precomputed": precomputed, "total": shares + precomputed}
+
+    # Store g_i + g_j of the rows [start, stop) in the precomputed operand
+    def _UpdateOperand(self, start: int, stop: int) -> None:
+        block_rows = self._block_rows()
+        for block in range(start, stop, block_rows):
+            end = min(block + block_rows, stop)
+            self._operand_sum[block:end] = ring_reduce(self._share_i[block:end] + self._share_j[block:end], self.k)
+
+    # Allocate the precomputed operand for the whole capacity and fill the used rows
+    def _BuildOperand(self) -> None:
+        self._operand_sum = np.zeros((self.capacity, self.vector_length), dtype=self._share_i.dtype)
+        self._UpdateOperand(0, self._count)
+
+    # Precompute, once, the g_i + g_j operand that every query recombines, so that a
+    # query costs the two matrix-vector products only. Opt-in: it takes one more matrix
+    # of the size of a share matrix (see MemoryUsage), in RAM even for galleries on disk
+    def EnablePrecompute(self) -> dict:
+        with self._lock:
+            self._BuildOperand()
+        return self.MemoryUsage()
+
+    def DisablePrecompute(self) -> None:
+        with self._lock:
+            self._operand_sum = None
+
+    # Rows processed per block of the matching kernel
+    def _block_rows(self, block_rows: int = None) -> int:
+        if block_rows is None:
+            block_rows = max(1, BLOCK_ELEMENTS // max(1, self.vector_length))
+        return block_rows
+
+    # Compute this party's single shares of the N dot products between the
+    # query and every code in the gallery (one matrix-vector product per block).
+    # `rows` restricts the scoring to a range (start, stop) of gallery rows
+    def LocalMatch(
+        self,
+        query_shares: MPC_ArrayShares,
+        r: np.ndarray | int = 0,
+        block_rows: int = None,
+        rows: tuple[int, int] = None,
+    ) -> np.ndarray:
+
+        # Check the query shares
+        assert (
+            query_shares.party == self.party and query_shares.order == self.order
+        ), "Exception: The query shares must belong to the same party and order."
+        assert query_shares.shape == (
+            self.vector_length,
+        ), "Exception: The query must have the same length as the gallery codes."
+
+        k = self.k
+        q_sum = ring_reduce(query_shares.share_i + query_shares.share_j, k)
+        share_scores = self._Scan([(slice(None), q_sum, query_shares.share_j)], block_rows, rows)[0]
+
+        if not np.isscalar(r) or r != 0:
+            share_scores = share_scores + to_ring(r, k)
+        return ring_reduce(share_scores, k)
+
+    # One blocked pass over the gallery rows. Every segment (columns, q_sum, q_j) of
+    # the rows is scored as (g_i + g_j)·q_sum - g_j·q_j while the block is in cache,
+    # so each gallery row is read from memory once for all the segments
+    def _Scan(self, segments: list[tuple], block_rows: int = None, rows: tuple[int, int] = None) -> np.ndarray:
+        k = self.k
+
+        # Snapshot of the gallery, so that concurrent enrollments do not affect this query
+        with self._lock:
+            gallery = self.shares
+            operand_sum = self._operand_sum
+        first, last = rows if rows is not None else (0, gallery.shape[0])
+        gallery = gallery[first:last]
+        num_codes = gallery.shape[0]
+
+        block_rows = self._block_rows(block_rows)
+        share_scores = np.empty((len(segments), num_codes), dtype=gallery.dtype)
+        for start in range(0, num_codes, block_rows):
+            stop = min(start + block_rows, num_codes)
+            if operand_sum is not None:
+                g_sum = operand_sum[first + start:first + stop]
+            else:
+                g_sum = ring_reduce(gallery.share_i[start:stop] + gallery.share_j[start:stop], k)
+            g_j = gallery.share_j[start:stop]
+
+            # (g_i + g_j)·(q_i + q_j) - g_j·q_j for every row of the block and every segment
+            for s, (columns, q_sum, q_j) in enumerate(segments):
+                share_scores[s, start:stop] = ring_matvec(g_sum[:, columns], q_sum, k) - ring_matvec(g_j[:, columns], q_j, k)
+        return share_scores
+
+    # Compute this party's single shares of several scores per gallery row in a single
+    # pass, for galleries whose rows are the concatenation of segments (e.g. the masked
+    # code and the mask, see split_fused_gallery): segment s of every row is scored
+    # against segment_queries[s]. Returns an S x N matrix (one row per segment)
+    def LocalMatchSegments(
+        self,
+        segment_queries: list[MPC_ArrayShares],
+        r: np.ndarray | int = 0,
+        block_rows: int = None,
+        rows: tuple[int, int] = None,
+    ) -> np.ndarray:
+
+        # Check the query shares
+        for query_shares in segment_queries:
+            assert (
+                query_shares.party == self.party and query_shares.order == self.order
+            ), "Exception: The query shares must belong to the same party and order."
+        lengths = [query_shares.shape[0] for query_shares in segment_queries]
+        assert sum(lengths) == self.vector_length, "Exception: The segments must cover the gallery rows."
+
+        k = self.k
+        segments = []
+        offset = 0
+        for query_shares, length in zip(segment_queries, lengths):
+            q_sum = ring_reduce(query_shares.share_i + query_shares.share_j, k)
+            segments.append((slice(offset, offset + length), q_sum, query_shares.share_j))
+            offset += length
+        share_scores = self._Scan(segments, block_rows, rows)
+
+        if not np.isscalar(r) or r != 0:
+            share_scores = share_scores + to_ring(r, k)
+        return ring_reduce(share_scores, k)
+
+    # Compute this party's single shares of the Q x N score matrix between a
+    # batch of Q shared queries (Q x vector_length) and the gallery. The tile
+    # sizes bound the temporaries to tile_queries x tile_rows scores
+    def LocalMatchBatch(
+        self,
+        queries_shares: MPC_ArrayShares,
+        r: np.ndarray | int = 0,
+        tile_queries: int = 256,
+        tile_rows: int = None,
+    ) -> np.ndarray:
+
+        # Check the queries shares
+        assert (
+            queries_shares.party == self.party and queries_shares.order == self.order
+        ), "Exception: The query shares must belong to the same party and order."
+        assert (
+            len(queries_shares.shape) == 2 and queries_shares.shape[1] == self.vector_length
+        ), "Exception: The queries must be a matrix of codes of the gallery length."
+
+        with self._lock:
+            gallery = self.shares
+            rows_sum = self._operand_sum[:self._count] if self.precomputed else None
+        return queries_shares.LocalBatchDotProduct(
+            gallery, r=r, tile_rows=tile_queries, tile_cols=self._block_rows(tile_rows), rows_sum=rows_sum
+        )
+
+    # Compute this party's single shares of the scores of every circular shift of the
+    # query against every gallery row: the S rotated copies of the query shares are
+    # built locally and scored as one (S x L)·(L x N) product. Returns an S x N matrix
+    def LocalMatchRotations(
+        self,
+        query_shares: MPC_ArrayShares,
+        shifts,
+        r: np.ndarray | int = 0,
+        tile_rows: int = None,
+    ) -> np.ndarray:
+        assert len(query_shares.shape) == 1, "Exception: The query must be a single code."
+        return self.LocalMatchBatch(rotated_queries(query_shares, shifts), r=r, tile_queries=len(shifts), tile_rows=tile_rows)
+
+    # Write the gallery of this party to a directory (see GALLERY_FORMAT)
+    def Save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        shape = (self.num_codes, self.vector_length)
+
+        for file, component in ((SHARE_I_FILE, self.shares.share_i), (SHARE_J_FILE, self.shares.share_j)):
+            array = np.memmap(os.path.join(path, file), dtype=self.shares.dtype, mode="w+", shape=shape)
+            array[:] = component
+            array.flush()
+        ids = np.memmap(os.path.join(path, ROW_IDS_FILE), dtype=np.int64, mode="w+", shape=(self.num_codes,))
+        ids[:] = self.row_ids
+        ids.flush()
+
+        meta = {
+            "format": GALLERY_FORMAT,
+            "party": self.party,
+            "order": self.order,
+            "k": self.k,
+            "dtype": self.shares.dtype.name,
+            "num_codes": self.num_codes,
+            "capacity": self.num_codes,
+            "vector_length": self.vector_length,
+            "generation": self.generation,
+        }
+        with open(os.path.join(path, META_FILE), "w") as f:
+            json.dump(meta, f)
+
+    # Update the metadata of a gallery stored on disk
+    def _WriteMeta(self) -> None:
+        meta_path = os.path.join(self.path, META_FILE)
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta["num_codes"] = self._count
+        meta["capacity"] = self.capacity
+        meta["generation"] = self.generation = meta.get("generation", 0) + 1
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    # Open a gallery written by Save without loading it: the share matrices are
+    # memory-mapped, so pages are read lazily as the matching kernel touches them.
+    # `precompute` enables the precomputed g_i + g_j operand (kept in RAM)
+    @classmethod
+    def Open(cls, path: str, mode: str = "r", precompute: bool = False) -> SharedGallery:
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        assert meta["format"] == GALLERY_FORMAT, "Exception: Unsupported gallery format."
+
+        num_codes, capacity = meta["num_codes"], meta["capacity"]
+        shape = (capacity, meta["vector_length"])
+        dtype = np.dtype(meta["dtype"])
+
+        share_i = np.memmap(os.path.join(path, SHARE_I_FILE), dtype=dtype, mode=mode, shape=shape)
+        share_j = np.memmap(os.path.join(path, SHARE_J_FILE), dtype=dtype, mode=mode, shape=shape)
+        row_ids = np.memmap(os.path.join(path, ROW_IDS_FILE), dtype=np.int64, mode=mode, shape=(capacity,))
+
+        shares = MPC_ArrayShares(share_i[:num_codes], share_j[:num_codes], meta["party"], meta["order"])
+        gallery = cls(shares, row_ids[:num_codes])
+
+        # Keep the whole allocated storage, so that the gallery can grow in place
+        gallery._share_i, gallery._share_j, gallery._row_ids = share_i, share_j, row_ids
+        gallery.generation = meta.get("generation", 0)
+        if mode != "r":
+            gallery.path = path
+        if precompute:
+            gallery.EnablePrecompute()
+        return gallery
+
+    # Write the pending changes of a gallery opened for writing to its files
+    def Flush(self) -> None:
+        with self._lock:
+            for array in (self._share_i, self._share_j, self._row_ids):
+                if isinstance(array, np.memmap):
+                    array.flush()
+
+    # Grow the storage to hold at least `rows` rows, in amortized chunks
+    def _Reserve(self, rows: int) -> None:
+        if rows <= self.capacity:
+            return
+        capacity = max(rows, int(self.capacity * GROWTH_FACTOR), self.capacity + MIN_CHUNK_ROWS)
+        shape = (capacity, self.vector_length)
+
+        if self.path is not None:
+            # Extend the files in place and map them again (no copy of the gallery)
+            arrays = []
+            for file, dtype, file_shape in (
+                (SHARE_I_FILE, self._share_i.dtype, shape),
+                (SHARE_J_FILE, self._share_j.dtype, shape),
+                (ROW_IDS_FILE, np.dtype(np.int64), (capacity,)),
+            ):
+                file_path = os.path.join(self.path, file)
+                with open(file_path, "r+b") as f:
+                    f.truncate(int(np.prod(file_shape)) * dtype.itemsize)
+                arrays.append(np.memmap(file_path, dtype=dtype, mode="r+", shape=file_shape))
+            self._share_i, self._share_j, self._row_ids = arrays
+        else:
+            share_i = np.zeros(shape, dtype=self._share_i.dtype)
+            share_j = np.zeros(shape, dtype=self._share_j.dtype)
+            row_ids = np.full(capacity, DELETED_ID, dtype=np.int64)
+            share_i[:self._count] = self._share_i[:self._count]
+            share_j[:self._count] = self._share_j[:self._count]
+            row_ids[:self._count] = self._row_ids[:self._count]
+            self._share_i, self._share_j, self._row_ids = share_i, share_j, row_ids
+
+        # Grow the precomputed operand with the storage
+        if self.precomputed:
+            operand_sum = np.zeros(shape, dtype=self._operand_sum.dtype)
+            operand_sum[:self._count] = self._operand_sum[:self._count]
+            self._operand_sum = operand_sum
+
+    # Append the shares of new codes (M x vector_length) to the gallery of this party
+    def Enroll(self, shares: MPC_ArrayShares, row_ids: np.ndarray = None) -> np.ndarray:
+
+        # Check the new shares
+        assert (
+            shares.party == self.party and shares.order == self.order
+        ), "Exception: The shares must belong to the same party and order."
+        assert (
+            len(shares.shape) == 2 and shares.shape[1] == self.vector_length
+        ), "Exception: The new codes must have the same length as the gallery codes."
+
+        with self._lock:
+            num_new = shares.shape[0]
+            if row_ids is None:
+                row_ids = np.arange(self.next_row_id, self.next_row_id + num_new, dtype=np.int64)
+            assert len(row_ids) == num_new, "Exception: There must be one row id per new code."
+
+            start, stop = self._count, self._count + num_new
+            self._Reserve(stop)
+            self._share_i[start:stop] = shares.share_i
+            self._share_j[start:stop] = shares.share_j
+            self._row_ids[start:stop] = row_ids
+            if self.precomputed:
+                self._UpdateOperand(start, stop)
+            self._count = stop
+            self.next_row_id = max(self.next_row_id, int(np.max(row_ids, initial=-1)) + 1)
+
+            if self.path is not None:
+                self._WriteMeta()
+        return np.asarray(row_ids)
+
+    # Tombstone rows of the gallery: their shares are zeroed (a valid sharing of 0)
+    # and their id set to DELETED_ID until the next compaction
+    def Delete(self, row_ids) -> None:
+        with self._lock:
+            positions = np.flatnonzero(np.isin(self.row_ids, np.asarray(row_ids, dtype=np.int64)))
+            self._share_i[positions] = 0
+            self._share_j[positions] = 0
+            self._row_ids[positions] = DELETED_ID
+            if self.precomputed:
+                self._operand_sum[positions] = 0
+
+    # Start removing the tombstoned rows. The rows to keep are fixed now, and they are
+    # copied to a new storage in a background thread while queries, enrollments and
+    # deletions keep running on the current storage
+    def StartCompaction(self) -> threading.Thread:
+        with self._lock:
+            assert self._compaction is None, "Exception: A compaction is already running."
+            count = self._count
+            keep = np.flatnonzero(self._row_ids[:count] != DELETED_ID)
+            source = (self._share_i, self._share_j, self._row_ids)
+
+            capacity = max(len(keep), 1)
+            shape = (capacity, self.vector_length)
+            if self.path is not None:
+                files = [os.path.join(self.path, file + ".compact") for file in (SHARE_I_FILE, SHARE_J_FILE, ROW_IDS_FILE)]
+                target = (
+                    np.memmap(files[0], dtype=source[0].dtype, mode="w+", shape=shape),
+                    np.memmap(files[1], dtype=source[1].dtype, mode="w+", shape=shape),
+                    np.memmap(files[2], dtype=np.int64, mode="w+", shape=(capacity,)),
+                )
+            else:
+                target = (
+                    np.zeros(shape, dtype=source[0].dtype),
+                    np.zeros(shape, dtype=source[1].dtype),
+                    np.full(capacity, DELETED_ID, dtype=np.int64),
+                )
+
+        # Copy the rows to keep block by block
+        def copy_rows():
+            block_rows = self._block_rows()
+            for start in range(0, len(keep), block_rows):
+                rows = keep[start:start + block_rows]
+                for old, new in zip(source, target):
+                    new[start:start + len(rows)] = old[rows]
+
+        thread = threading.Thread(target=copy_rows, daemon=True)
+        self._compaction = (thread, count, keep, target)
+        thread.start()
+        return thread
+
+    # Swap in the compacted storage once the copy is done. Rows deleted during the copy
+    # stay tombstoned and rows enrolled during the copy are appended again, so every
+    # party ends with the same layout as long as they receive the same sequence of
+    # Enroll/Delete/StartCompaction/FinishCompaction calls
+    def FinishCompaction(self) -> None:
+        assert self._compaction is not None, "Exception: No compaction is running."
+        thread, count, keep, (share_i, share_j, row_ids) = self._compaction
+        thread.join()
+
+        with self._lock:
+            # Rows deleted during the copy stay tombstoned in the new storage
+            deleted = np.flatnonzero(self._row_ids[keep] == DELETED_ID)
+            share_i[deleted] = 0
+            share_j[deleted] = 0
+            row_ids[deleted] = DELETED_ID
+
+            # Rows enrolled during the copy are moved to the new storage
+            enrolled = MPC_ArrayShares(
+                np.array(self._share_i[count:self._count]), np.array(self._share_j[count:self._count]),
+                self.party, self.order,
+            )
+            enrolled_ids = np.array(self._row_ids[count:self._count])
+
+            if self.path is not None:
+                for file, array in zip((SHARE_I_FILE, SHARE_J_FILE, ROW_IDS_FILE), (share_i, share_j, row_ids)):
+                    array.flush()
+                    os.replace(os.path.join(self.path, file + ".compact"), os.path.join(self.path, file))
+            self._share_i, self._share_j, self._row_ids = share_i, share_j, row_ids
+            self._count = len(keep)
+            self._compaction = None
+            if self.precomputed:
+                self._BuildOperand()
+            if len(enrolled_ids) > 0:
+                self.Enroll(enrolled, enrolled_ids)
+            elif self.path is not None:
+                self._WriteMeta()
+
+    # Remove the tombstoned rows (blocking)
+    def Compact(self) -> None:
+        self.StartCompaction()
+        self.FinishCompaction()
+
+    # Number of tombstoned rows waiting for the next compaction
+    @property
+    def num_deleted(self) -> int:
+        return int(np.count_nonzero(self.row_ids == DELETED_ID))
+
+# Generation of the gallery stored in a directory (see SharedGallery.generation)
+def stored_generation(path: str) -> int:
+    with open(os.path.join(path, META_FILE)) as f:
+        return json.load(f).get("generation", 0)
+
+# Split a plaintext gallery (num_codes x vector_length) into the 3 parties' galleries
+def split_gallery(mpc: MPC, codes: np.ndarray) -> tuple[SharedGallery, SharedGallery, SharedGallery]:
+    shares_p1, shares_p2, shares_p3 = mpc.SplitArraySecret(np.atleast_2d(codes))
+    return SharedGallery(shares_p1), SharedGallery(shares_p2), SharedGallery(shares_p3)
+
+# Split a plaintext gallery of masked codes and masks into galleries whose rows
+# are the code followed by the mask (for LocalMatchSegments)
+def split_fused_gallery(mpc: MPC, masked_codes: np.ndarray, masks: np.ndarray) -> tuple[SharedGallery, SharedGallery, SharedGallery]:
+    return split_gallery(mpc, np.hstack([np.atleast_2d(masked_codes), np.atleast_2d(masks)]))
+
+# Rotated copies of the shares of a query, one row per circular shift (in elements).
+# A rotation only moves the components, so it needs no communication
+def rotated_queries(query_shares: MPC_ArrayShares, shifts) -> MPC_ArrayShares:
+    return MPC_ArrayShares(
+        np.stack([np.roll(query_shares.share_i, shift) for shift in shifts]),
+        np.stack([np.roll(query_shares.share_j, shift) for shift in shifts]),
+        query_shares.party,
+        query_shares.order,
+    )
+
+# Split new plaintext codes and append them to the 3 parties' galleries
+def enroll_codes(
+    mpc: MPC, galleries: tuple[SharedGallery, SharedGallery, SharedGallery], codes: np.ndarray, row_ids: np.ndarray = None
+) -> np.ndarray:
+    if row_ids is None:
+        next_row_id = max(gallery.next_row_id for gallery in galleries)
+        row_ids = np.arange(next_row_id, next_row_id + len(np.atleast_2d(codes)), dtype=np.int64)
+    shares = mpc.SplitArraySecret(np.atleast_2d(codes))
+    for gallery in galleries:
+        gallery.Enroll(shares[gallery.party], row_ids)
+    return row_ids
@@ -1,6 +1,8 @@
 import numpy as np
 from MPC import MPC
 from utils import signed_integer, mask_bits
+from gallery import split_gallery
+from correlated import setup_zero_sharing
 
 # Parameters
 k = 16
@@ -179,7 +181,61 @@ def many_codes_test(num_codes, vector_length, match_index=None, debug=False):
 
     print("\nMatches: ", matches)
 
+def many_codes_batched_test(num_codes, vector_length, match_index=None, debug=False):
+    # Instatiate the MPC class
+    mpc = MPC(k)
+
+    # Generate many random codes and masks in database
+    codes_db = np.random.randint(0, 2, (num_codes, vector_length))
+    masks_db = np.random.randint(0, 2, (num_codes, vector_length))
+
+    # Select a code from the database to be the query code (forcing a coincidence)
+    if match_index is not None:
+        if match_index >= num_codes:
+            raise ValueError("ERROR - Invalid match index")
+        code_query = codes_db[match_index]
+    else:
+        code_query = np.random.randint(0, 2, vector_length)
+    mask_query = np.random.randint(0, 2, vector_length)
+
+    # Masked codes
+    masked_code_query = mask_bits(code_query, mask_query)
+    masked_codes_db = mask_bits(codes_db, masks_db)
+
+    # Split the whole database once into share matrices, and the query into shares
+    gallery_p1, gallery_p2, gallery_p3 = split_gallery(mpc, masked_codes_db)
+    shares_code_query_p1, shares_code_query_p2, shares_code_query_p3 = mpc.SplitArraySecret(masked_code_query)
+
+    # Pairwise PRF keys to re-randomize the dot products before resharing
+    zeros_p1, zeros_p2, zeros_p3 = setup_zero_sharing(k)
+
+    # All the dot products of the query against the database in one pass per party
+    share_dp_p1 = gallery_p1.LocalMatch(shares_code_query_p1, r=zeros_p1.Next(num_codes))
+    share_dp_p2 = gallery_p2.LocalMatch(shares_code_query_p2, r=zeros_p2.Next(num_codes))
+    share_dp_p3 = gallery_p3.LocalMatch(shares_code_query_p3, r=zeros_p3.Next(num_codes))
+
+    # Reshare and reconstruct the whole score vector
+    shares_dp_p1, shares_dp_p2, shares_dp_p3 = mpc.ArrayResharing(share_dp_p1, share_dp_p2, share_dp_p3)
+    dp_signed = signed_integer(mpc.ReconstructArraySecret(shares_dp_p1, shares_dp_p2), k)
+
+    # Check if the dot products are equal to the reference dot products
+    dp_real = masked_codes_db @ masked_code_query
+    if not np.array_equal(dp_signed, dp_real):
+        raise ValueError("ERROR - MPC dot product is not equal to the reference dot product")
+
+    # Check which dot products are more than the match ratio
+    masks_ones = np.bitwise_and(mask_query, masks_db).sum(axis=1)
+    thresholds = (1 - 2 * match_ratio) * masks_ones
+    matches = [[int(i), int(dp_signed[i]), thresholds[i]] for i in np.flatnonzero(dp_signed > thresholds)]
+
+    if debug:
+        print("\nDot products of code query and codes DB: ", dp_signed)
+        print("Thresholds: ", thresholds)
+
+    print("\nMatches: ", matches)
+
 # Main function
 if __name__ == "__main__":
     # simple_test(debug=False)
     many_codes_test(num_codes, vector_length, match_index=100, debug=False)
+    # many_codes_batched_test(num_codes, vector_length, match_index=100, debug=False)
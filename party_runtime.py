@@ -0,0 +1,244 @@
+# Three-party runtime: every party runs in its own OS process and talks to the other
+# two over local sockets. Party p (0, 1, 2 for P1, P2, P3) only sends
+#   - resharing: its single share z_p to party p+1 (which lacks component p)
+#   - opening:   its component p to party p-1 (which lacks component p)
+# so each party receives exactly the values the replicated protocol says it should.
+from __future__ import annotations
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import tempfile
+import threading
+from multiprocessing.connection import Client, Connection, Listener
+import numpy as np
+from MPC import MPC, MPC_ArrayShares
+from correlated import ZeroSharing
+from gallery import SharedGallery, split_gallery
+from prg import SEED_BYTES
+from ring import ring_reduce
+from utils import mask_bits, signed_integer
+from wire import decode_frame, frame_bytes
+
+# Class to handle the connections of one party to the previous and next parties
+class PartyChannels:
+    def __init__(self, party: int, conn_next: Connection, conn_prev: Connection) -> PartyChannels:
+        self.party = party
+        self.conn_next = conn_next
+        self.conn_prev = conn_prev
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.messages_sent = 0
+
+    def _Send(self, conn: Connection, message) -> None:
+        message = memoryview(message)
+        conn.send_bytes(message)
+        self.bytes_sent += message.nbytes
+        self.messages_sent += 1
+
+    def _Recv(self, conn: Connection) -> bytes:
+        message = conn.recv_bytes()
+        self.bytes_received += len(message)
+        return message
+
+    # Send a message to one neighbour while receiving one from the other. The send
+    # runs in a thread so that the 3 parties never block each other on full buffers
+    def Exchange(self, message: bytes, send_to_next: bool = True) -> bytes:
+        conn_send, conn_recv = (self.conn_next, self.conn_prev) if send_to_next else (self.conn_prev, self.conn_next)
+        sender = threading.Thread(target=self._Send, args=(conn_send, message))
+        sender.start()
+        received = self._Recv(conn_recv)
+        sender.join()
+        return received
+
+    def Close(self) -> None:
+        self.conn_next.close()
+        self.conn_prev.close()
+
+# Class to handle the protocol operations of one party over its channels
+class PartyRuntime:
+    def __init__(self, party: int, channels: PartyChannels, k: int) -> PartyRuntime:
+        self.party = party
+        self.channels = channels
+        self.k = int(k)
+        self.order = 2**self.k
+        self.zero_sharing = None
+
+    # Set up the pairwise PRF keys: party p draws K_p and sends it to party p+1
+    def SetupZeroSharing(self) -> ZeroSharing:
+        key_own = os.urandom(SEED_BYTES)
+        key_prev = self.channels.Exchange(key_own, send_to_next=True)
+        self.zero_sharing = ZeroSharing(self.party, key_own, key_prev, self.k)
+        return self.zero_sharing
+
+    # Turn this party's single (3-out-of-3) shares into replicated shares:
+    # send z_p to party p+1 and receive z_{p-1} from party p-1. All the arrays of
+    # the round go in one frame
+    def ReshareBatch(self, shares: list[np.ndarray]) -> list[MPC_ArrayShares]:
+        shares = [np.asarray(share) for share in shares]
+        shares_prev = decode_frame(self.channels.Exchange(frame_bytes(shares, self.k), send_to_next=True))
+        return [
+            MPC_ArrayShares(share, share_prev.copy(), self.party, self.order)
+            for share, share_prev in zip(shares, shares_prev)
+        ]
+
+    def Reshare(self, share: np.ndarray) -> MPC_ArrayShares:
+        return self.ReshareBatch([share])[0]
+
+    # Open shared values to this party: send component p to party p-1 and receive
+    # component p+1 (the one this party lacks) from party p+1. All the arrays of
+    # the round go in one frame
+    def OpenBatch(self, shares: list[MPC_ArrayShares]) -> list[np.ndarray]:
+        frame = frame_bytes([s.share_i for s in shares], self.k)
+        shares_next = decode_frame(self.channels.Exchange(frame, send_to_next=False))
+        return [
+            ring_reduce(s.share_i + s.share_j + share_next, self.k)
+            for s, share_next in zip(shares, shares_next)
+        ]
+
+    def Open(self, shares: MPC_ArrayShares) -> np.ndarray:
+        return self.OpenBatch([shares])[0]
+
+# Interval of the checks for failed party processes while waiting for them (seconds)
+POLL_INTERVAL = 0.1
+
+# Exception raised in a party process, in a form that can be sent to the parent
+def picklable_error(error: BaseException) -> BaseException:
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(f"Exception in a party process: {error!r}")
+
+# Stop the party processes and raise the error reported by the failed party (the
+# result queue carries (party, error, result) items). The connection errors of the
+# neighbours of a failed party are only raised when no other error was reported
+def stop_parties(processes: list, result_queue, error: BaseException = None) -> None:
+    errors = [] if error is None else [error]
+    while True:
+        try:
+            _, error, _ = result_queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            if all(not process.is_alive() for process in processes):
+                break
+            for process in processes:
+                process.terminate()
+            continue
+        if error is not None:
+            errors.append(error)
+    for process in processes:
+        process.join()
+
+    causes = [error for error in errors if not isinstance(error, (ConnectionError, EOFError))]
+    if causes or errors:
+        raise (causes or errors)[0]
+    raise RuntimeError(f"Exception: A party process failed (exit codes {[p.exitcode for p in processes]}).")
+
+# Next item of a queue filled by the party processes, raising instead of waiting
+# forever if one of them has failed
+def wait_for(items, processes: list, result_queue):
+    while True:
+        try:
+            return items.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            if any(process.exitcode not in (None, 0) for process in processes):
+                stop_parties(processes, result_queue)
+
+# Results of the 3 party processes, in party order. The first error reported by a
+# party stops the others and is raised here
+def collect_results(processes: list, result_queue) -> list:
+    results = [None, None, None]
+    for _ in range(3):
+        party, error, result = wait_for(result_queue, processes, result_queue)
+        if error is not None:
+            stop_parties(processes, result_queue, error)
+        results[party] = result
+    for process in processes:
+        process.join()
+    return results
+
+# Entry point of a party process: connect to the neighbours and run the party function.
+# An exception is reported to the parent before the process exits with it
+def _party_main(party, k, function, args, address_queue, addresses_conn, result_queue):
+    channels = None
+    try:
+        listener = Listener(("localhost", 0), authkey=None)
+        address_queue.put((party, listener.address))
+        addresses = addresses_conn.recv()
+
+        # Party p connects to party p+1 and accepts the connection of party p-1
+        conn_next = Client(addresses[(party + 1) % 3], authkey=None)
+        conn_prev = listener.accept()
+        listener.close()
+
+        channels = PartyChannels(party, conn_next, conn_prev)
+        runtime = PartyRuntime(party, channels, k)
+        result = function(runtime, *args)
+        result_queue.put((party, None, (result, channels.bytes_sent, channels.bytes_received)))
+    except BaseException as error:
+        result_queue.put((party, picklable_error(error), None))
+        raise
+    finally:
+        if channels is not None:
+            channels.Close()
+
+# Run `function(runtime, *args_per_party[p])` in 3 party processes on localhost.
+# Returns, per party, the result and the bytes it sent and received. If a party
+# raises, the other parties are stopped and its exception is raised here
+def run_parties(function, args_per_party: list[tuple], k: int) -> list[tuple]:
+    context = mp.get_context("fork")
+    address_queue = context.Queue()
+    result_queue = context.Queue()
+    pipes = [context.Pipe() for _ in range(3)]
+
+    processes = [
+        context.Process(
+            target=_party_main,
+            args=(party, k, function, args_per_party[party], address_queue, pipes[party][1], result_queue),
+        )
+        for party in range(3)
+    ]
+    for process in processes:
+        process.start()
+
+    # Distribute the listening addresses of the 3 parties
+    addresses = dict(wait_for(address_queue, processes, result_queue) for _ in range(3))
+    for conn, _ in pipes:
+        conn.send(addresses)
+
+    return collect_results(processes, result_queue)
+##########################################################################################
+
+# Party function of a 1:N search: score the query against the gallery stored on disk,
+# re-randomize, reshare and open the score vector
+def search_party(runtime: PartyRuntime, gallery_path: str, query_shares: MPC_ArrayShares) -> np.ndarray:
+    gallery = SharedGallery.Open(gallery_path)
+    zero_sharing = runtime.SetupZeroSharing()
+
+    share_scores = gallery.LocalMatch(query_shares, r=zero_sharing.Next(gallery.num_codes))
+    score_shares = runtime.Reshare(share_scores)
+    return runtime.Open(score_shares)
+
+def search_test(num_codes: int = 500, vector_length: int = 10000, k: int = 16):
+    mpc = MPC(k)
+    codes_db = mask_bits(np.random.randint(0, 2, (num_codes, vector_length)), np.random.randint(0, 2, (num_codes, vector_length)))
+    code_query = mask_bits(np.random.randint(0, 2, vector_length), np.random.randint(0, 2, vector_length))
+
+    # Enrollment (dealer): every party gets its gallery on disk and its query shares
+    directory = tempfile.mkdtemp()
+    galleries = split_gallery(mpc, codes_db)
+    for gallery in galleries:
+        gallery.Save(os.path.join(directory, f"party{gallery.party}"))
+    query_shares = mpc.SplitArraySecret(code_query)
+
+    args = [(os.path.join(directory, f"party{p}"), query_shares[p]) for p in range(3)]
+    results = run_parties(search_party, args, k)
+
+    reference = codes_db @ code_query
+    for party, (scores, bytes_sent, bytes_received) in enumerate(results):
+        assert np.array_equal(signed_integer(scores, k), reference), "Exception: Wrong scores."
+        print(f"Party {party + 1}: sent {bytes_sent} bytes, received {bytes_received} bytes")
+    print("Scores of the 3 parties match the reference")
+
+if __name__ == "__main__":
+    search_test()
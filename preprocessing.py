@@ -0,0 +1,321 @@
+# Offline/online split of the correlated randomness.
+# The dealer material consumed by the online protocols (random sharings, daBits for the
+# bit conversions and truncation pairs for the fixed-point products) is generated ahead
+# of time into per-party pools. Every pool is a ring buffer of fixed capacity: the
+# online phase takes elements from the head, and a background dealer thread refills
+# the 3 parties' pools of a kind together whenever one of them falls below its low
+# watermark, so the material of the 3 parties stays aligned position by position.
+# The zero-sharings need no pool: the parties derive them locally from their PRF keys.
+from __future__ import annotations
+import threading
+import time
+import numpy as np
+from MPC import MPC, MPC_ArrayShares
+from bitsliced import MPC_BitShares, MPC_Bits, bitsliced_match, pack_bits, split_bit_gallery
+from comparison import SecureComparison
+from correlated import setup_zero_sharing
+from fixed_point import FRAC_BITS, FixedPoint
+from ring import ring_dtype
+from utils import mask_bits, signed_integer
+
+# Kinds of material and their columns (one element per row)
+KINDS = {
+    "random": ("share_i", "share_j"),
+    "dabits": ("bits_i", "bits_j", "share_i", "share_j"),
+    "truncation": ("r_i", "r_j", "t_i", "t_j"),
+}
+
+# Default sizes of the pools (elements) and of the refills
+POOL_CAPACITY = 2**20
+LOW_WATERMARK = 2**18
+
+# Class to handle the ring buffer of one kind of material of one party
+class MaterialPool:
+    def __init__(
+        self, kind: str, party: int, k: int, capacity: int = POOL_CAPACITY,
+        low_watermark: int = LOW_WATERMARK, wakeup: threading.Event = None,
+    ) -> MaterialPool:
+        assert kind in KINDS, "Exception: Unknown kind of material."
+        assert 0 <= low_watermark < capacity, "Exception: The low watermark must be below the capacity."
+        self.kind = kind
+        self.party = party
+        self.k = int(k)
+        self.capacity = capacity
+        self.low_watermark = low_watermark
+        self.columns = {
+            name: np.empty(capacity, dtype=np.uint64 if name.startswith("bits") else ring_dtype(self.k))
+            for name in KINDS[kind]
+        }
+        self._head = 0
+        self._size = 0
+        self._condition = threading.Condition()
+
+        # Elements wanted by a consumer waiting on this pool (0 when none is waiting)
+        self._demand = 0
+
+        # Event set when the pool falls below its low watermark (wakes up the dealer)
+        self.wakeup = wakeup
+
+        # Metrics
+        self.produced = 0
+        self.consumed = 0
+        self.underruns = 0
+        self.wait_time = 0.0
+        self.min_available = capacity
+
+    @property
+    def available(self) -> int:
+        return self._size
+
+    @property
+    def free(self) -> int:
+        return self.capacity - self._size
+
+    # Below the low watermark, or too short for a waiting consumer
+    def NeedsRefill(self) -> bool:
+        return self._size < max(self.low_watermark, self._demand)
+
+    # Positions of `count` elements starting at `start` in the ring buffer
+    def _Positions(self, start: int, count: int) -> np.ndarray:
+        return (start + np.arange(count)) % self.capacity
+
+    # Append material at the tail (called by the dealer)
+    def Put(self, columns: dict) -> None:
+        count = len(next(iter(columns.values())))
+        with self._condition:
+            assert count <= self.free, "Exception: The pool has no room for the material."
+            positions = self._Positions(self._head + self._size, count)
+            for name, values in columns.items():
+                self.columns[name][positions] = values
+            self._size += count
+            self.produced += count
+            self._condition.notify_all()
+
+    # Take `count` elements from the head, waiting for the dealer if the pool runs dry
+    def Take(self, count: int) -> dict:
+        assert count <= self.capacity, "Exception: More material requested than the pool can hold."
+        with self._condition:
+            if self._size < count:
+                # Wake up the dealer before waiting (the pool may be above its low watermark)
+                self.underruns += 1
+                self._demand = count
+                if self.wakeup is not None:
+                    self.wakeup.set()
+                start = time.perf_counter()
+                self._condition.wait_for(lambda: self._size >= count)
+                self.wait_time += time.perf_counter() - start
+                self._demand = 0
+            positions = self._Positions(self._head, count)
+            columns = {name: values[positions] for name, values in self.columns.items()}
+            self._head = (self._head + count) % self.capacity
+            self._size -= count
+            self.consumed += count
+            self.min_available = min(self.min_available, self._size)
+            if self.wakeup is not None and self.NeedsRefill():
+                self.wakeup.set()
+        return columns
+
+    def Metrics(self) -> dict:
+        return {
+            "kind": self.kind,
+            "party": self.party,
+            "available": self._size,
+            "capacity": self.capacity,
+            "low_watermark": self.low_watermark,
+            "min_available": self.min_available,
+            "produced": self.produced,
+            "consumed": self.consumed,
+            "underruns": self.underruns,
+            "wait_ms": self.wait_time * 1000,
+        }
+
+    # Store the available material in a file (e.g. at the end of the offline phase)
+    def Save(self, path: str) -> None:
+        with self._condition:
+            positions = self._Positions(self._head, self._size)
+            np.savez(path, kind=self.kind, party=self.party, k=self.k, **{n: v[positions] for n, v in self.columns.items()})
+
+    # Load the material stored by Save into a new pool
+    @classmethod
+    def Load(cls, path: str, capacity: int = POOL_CAPACITY, low_watermark: int = LOW_WATERMARK) -> MaterialPool:
+        with np.load(path) as data:
+            pool = cls(str(data["kind"]), int(data["party"]), int(data["k"]), capacity, low_watermark)
+            pool.Put({name: data[name] for name in KINDS[pool.kind]})
+        pool.produced = 0
+        return pool
+
+# Class to handle the dealer of the offline phase and the online access to the pools
+# of the 3 parties. It provides the same material as the inline dealer methods
+# (MPC_Bits.DaBits, FixedPoint.TruncationPairs), taken from the pools
+class Preprocessor:
+    def __init__(
+        self, mpc: MPC, kinds: tuple = tuple(KINDS), capacity: int = POOL_CAPACITY,
+        low_watermark: int = LOW_WATERMARK, frac_bits: int = FRAC_BITS,
+    ) -> Preprocessor:
+        self.mpc = mpc
+        self.k = int(mpc.k)
+        self.mpc_bits = MPC_Bits(mpc)
+        self.fixed = FixedPoint(mpc, frac_bits)
+        self._wakeup = threading.Event()
+        self.pools = {
+            kind: [MaterialPool(kind, p, self.k, capacity, low_watermark, self._wakeup) for p in range(3)]
+            for kind in kinds
+        }
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Serializes the consumers, so that the 3 parties' pools are taken in the same order
+        self._take_lock = threading.Lock()
+
+        # Time spent generating material
+        self.generation_time = 0.0
+
+    # Generate `count` elements of a kind for the 3 parties
+    def _Generate(self, kind: str, count: int) -> list[dict]:
+        if kind == "random":
+            shares = self.mpc.SplitArraySecret(self.mpc.prg.RandomRing(count, self.k))
+            return [{"share_i": s.share_i, "share_j": s.share_j} for s in shares]
+        if kind == "dabits":
+            bits, ring = self.mpc_bits.DaBits((count,), 1)
+            return [
+                {"bits_i": b.bits_i[:, 0], "bits_j": b.bits_j[:, 0], "share_i": r.share_i[:, 0], "share_j": r.share_j[:, 0]}
+                for b, r in zip(bits, ring)
+            ]
+        r, t = self.fixed.TruncationPairs(count)
+        return [{"r_i": a.share_i, "r_j": a.share_j, "t_i": b.share_i, "t_j": b.share_j} for a, b in zip(r, t)]
+
+    # Fill the pools of a kind up to their capacity
+    def Refill(self, kind: str) -> None:
+        pools = self.pools[kind]
+        count = min(pool.free for pool in pools)
+        if count > 0:
+            start = time.perf_counter()
+            for pool, columns in zip(pools, self._Generate(kind, count)):
+                pool.Put(columns)
+            self.generation_time += time.perf_counter() - start
+
+    # Offline phase: fill all the pools
+    def Fill(self) -> None:
+        for kind in self.pools:
+            self.Refill(kind)
+
+    # Background dealer: refill the kinds whose pools fall below the low watermark
+    def Start(self, poll_interval: float = 0.1) -> None:
+        def refill_loop():
+            while not self._stop.is_set():
+                self._wakeup.clear()
+                for kind, pools in self.pools.items():
+                    if any(pool.NeedsRefill() for pool in pools):
+                        self.Refill(kind)
+                self._wakeup.wait(poll_interval)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=refill_loop, daemon=True)
+        self._thread.start()
+
+    def Stop(self) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Take aligned material of a kind from the pools of the 3 parties
+    def _Take(self, kind: str, count: int) -> list[dict]:
+        with self._take_lock:
+            return [pool.Take(count) for pool in self.pools[kind]]
+
+    # Shares of random ring elements
+    def RandomShares(self, shape) -> tuple[MPC_ArrayShares, MPC_ArrayShares, MPC_ArrayShares]:
+        shape = tuple(np.atleast_1d(shape))
+        columns = self._Take("random", int(np.prod(shape)))
+        return tuple(
+            MPC_ArrayShares(c["share_i"].reshape(shape), c["share_j"].reshape(shape), p, self.mpc.order)
+            for p, c in enumerate(columns)
+        )
+
+    # daBits of the given shape (same layout as MPC_Bits.DaBits): the nbits pooled
+    # single-bit daBits of a number are packed in its words, bit w from the w-th one
+    def DaBits(self, shape, nbits: int) -> tuple[tuple, tuple]:
+        shape = tuple(shape) + (nbits,)
+        columns = self._Take("dabits", int(np.prod(shape)))
+        bits = tuple(
+            MPC_BitShares(pack_bits(c["bits_i"].reshape(shape)), pack_bits(c["bits_j"].reshape(shape)), p, nbits)
+            for p, c in enumerate(columns)
+        )
+        ring = tuple(
+            MPC_ArrayShares(c["share_i"].reshape(shape), c["share_j"].reshape(shape), p, self.mpc.order)
+            for p, c in enumerate(columns)
+        )
+        return bits, ring
+
+    # Truncation pairs of the given shape (same layout as FixedPoint.TruncationPairs)
+    def TruncationPairs(self, shape) -> tuple[tuple, tuple]:
+        shape = tuple(np.atleast_1d(shape))
+        columns = self._Take("truncation", int(np.prod(shape)))
+        order = self.mpc.order
+        r = tuple(MPC_ArrayShares(c["r_i"].reshape(shape), c["r_j"].reshape(shape), p, order) for p, c in enumerate(columns))
+        t = tuple(MPC_ArrayShares(c["t_i"].reshape(shape), c["t_j"].reshape(shape), p, order) for p, c in enumerate(columns))
+        return r, t
+
+    def Metrics(self) -> list[dict]:
+        return [pool.Metrics() for pools in self.pools.values() for pool in pools]
+##########################################################################################
+
+def preprocessing_test(num_codes: int = 2000, num_queries: int = 20, k: int = 64):
+    mpc = MPC(k)
+    preprocessor = Preprocessor(mpc, capacity=4 * num_codes, low_watermark=2 * num_codes)
+
+    # Offline phase
+    preprocessor.Fill()
+    print(f"Offline phase: {preprocessor.generation_time * 1000:.1f} ms")
+
+    # Online phase: comparisons and truncations take their material from the pools
+    zero_sharings = setup_zero_sharing(k)
+    comparison = SecureComparison(MPC_Bits(mpc), zero_sharings, preprocessing=preprocessor)
+    fixed = FixedPoint(mpc, preprocessing=preprocessor)
+    preprocessor.Start()
+    start = time.perf_counter()
+    for _ in range(num_queries):
+        values = np.random.randint(-2**20, 2**20, num_codes)
+        bits = comparison.Msb(list(mpc.SplitArraySecret(values)))
+        signs = comparison.BitToArithmetic(bits)
+        assert np.array_equal(mpc.ReconstructArraySecret(signs[0], signs[1]), values < 0), "Exception: Wrong bits."
+
+        x = fixed.SplitFixed(values / 8)
+        halves = fixed.MultiplyPublic(x, 0.5)
+        assert np.all(np.abs(fixed.ReconstructFixed(halves[0], halves[1]) - values / 16) <= 1 / fixed.scale), "Exception: Wrong truncation."
+    elapsed = time.perf_counter() - start
+    preprocessor.Stop()
+
+    print(f"Online phase: {elapsed / num_queries * 1000:.1f} ms per query")
+    for metrics in preprocessor.Metrics():
+        print(metrics)
+
+# Bit-sliced 1:N search with the daBits of its popcounts taken from the pools
+def bitsliced_preprocessing_test(num_codes: int = 200, vector_length: int = 12800, num_queries: int = 5, k: int = 16):
+    mpc = MPC(k)
+    mpc_bits = MPC_Bits(mpc)
+    preprocessor = Preprocessor(mpc, kinds=("dabits",), capacity=8 * num_codes * k, low_watermark=4 * num_codes * k)
+    preprocessor.Fill()
+
+    codes_db, masks_db = np.random.randint(0, 2, (2, num_codes, vector_length))
+    galleries = split_bit_gallery(mpc_bits, codes_db, masks_db)
+    zero_sharings = setup_zero_sharing(k)
+    preprocessor.Start()
+    start = time.perf_counter()
+    for _ in range(num_queries):
+        code_query, mask_query = np.random.randint(0, 2, (2, vector_length))
+        query = split_bit_gallery(mpc_bits, code_query, mask_query)
+        scores = bitsliced_match(mpc_bits, query, galleries, zero_sharings, preprocessing=preprocessor)
+        expected = mask_bits(codes_db, masks_db) @ mask_bits(code_query, mask_query)
+        assert np.array_equal(signed_integer(scores, k), expected), "Exception: Wrong scores."
+    elapsed = time.perf_counter() - start
+    preprocessor.Stop()
+
+    print(f"Bit-sliced search from the pools: {elapsed / num_queries * 1000:.1f} ms per query")
+    print(preprocessor.Metrics()[0])
+
+if __name__ == "__main__":
+    preprocessing_test()
+    bitsliced_preprocessing_test()
@@ -0,0 +1,44 @@
+# Cryptographic pseudo-random generator for share generation.
+# Counter mode over the SHAKE-256 extendable-output function (hashlib): block c of
+# the stream is SHAKE-256(seed || c), so whole vectors or matrices of random ring
+# elements are drawn in one call and any block can be re-expanded from the seed
+from __future__ import annotations
+import hashlib
+import os
+import numpy as np
+from ring import ring_dtype, ring_reduce
+
+# Length of the seeds in bytes
+SEED_BYTES = 32
+
+# Class to handle a seeded stream of random bytes and ring elements
+class PRG:
+    def __init__(self, seed: bytes = None) -> PRG:
+        if seed is None:
+            seed = os.urandom(SEED_BYTES)
+        assert len(seed) >= 16, "Exception: The seed must have at least 128 bits."
+        self.seed = bytes(seed)
+        self.counter = 0
+
+    # Expand block `counter` of the stream into `num_bytes` random bytes
+    def Expand(self, counter: int, num_bytes: int) -> bytes:
+        return hashlib.shake_256(self.seed + counter.to_bytes(8, "little")).digest(num_bytes)
+
+    # Next `num_bytes` random bytes of the stream (one block per call)
+    def RandomBytes(self, num_bytes: int) -> bytes:
+        random_bytes = self.Expand(self.counter, num_bytes)
+        self.counter += 1
+        return random_bytes
+
+    # Uniformly distributed elements of Z_{2^k} with the given shape, from block `counter`
+    def ExpandRing(self, counter: int, shape, k: int) -> np.ndarray:
+        dtype = ring_dtype(k)
+        size = int(np.prod(shape))
+        array = np.frombuffer(bytearray(self.Expand(counter, size * dtype.itemsize)), dtype=dtype)
+        return ring_reduce(array.reshape(shape), k)
+
+    # Next array of uniformly distributed elements of Z_{2^k} of the stream
+    def RandomRing(self, shape, k: int) -> np.ndarray:
+        array = self.ExpandRing(self.counter, shape, k)
+        self.counter += 1
+        return array
@@ -0,0 +1,117 @@
+# Array arithmetic over the ring Z_{2^k} backed by unsigned NumPy dtypes.
+# The native wraparound of the dtype performs the reduction mod 2^k for free;
+# when k is not the full width of the dtype the high bits are masked off.
+from __future__ import annotations
+import numpy as np
+
+# Number of elements of an operand processed per block or tile by the kernels over
+# large matrices (keeps the temporaries, e.g. the float64 copies, in cache)
+BLOCK_ELEMENTS = 2**18
+
+# Smallest unsigned dtype that holds the elements of Z_{2^k}
+def ring_dtype(k: int) -> np.dtype:
+    k = int(k)
+    assert 1 <= k <= 64, "Exception: k must be between 1 and 64."
+    if k <= 8:
+        return np.dtype(np.uint8)
+    elif k <= 16:
+        return np.dtype(np.uint16)
+    elif k <= 32:
+        return np.dtype(np.uint32)
+    return np.dtype(np.uint64)
+
+# Reduce an array of the ring dtype modulo 2^k (in place when possible)
+def ring_reduce(array: np.ndarray, k: int) -> np.ndarray:
+    k = int(k)
+    if k == array.dtype.itemsize * 8:
+        return array
+    mask = array.dtype.type((1 << k) - 1)
+    if isinstance(array, np.ndarray) and array.ndim > 0 and array.flags.writeable:
+        np.bitwise_and(array, mask, out=array)
+        return array
+    return np.bitwise_and(array, mask)
+
+# Cast integers (possibly negative) to ring elements of Z_{2^k}
+def to_ring(values, k: int) -> np.ndarray:
+    dtype = ring_dtype(k)
+    values = np.asarray(values)
+    if values.dtype != dtype:
+        if values.dtype.kind == "u":
+            values = values.astype(dtype)
+        else:
+            # Two's complement wrap of negative values
+            values = values.astype(np.int64).astype(dtype)
+    else:
+        values = values.copy()
+    return ring_reduce(values, k)
+
+# Largest integer for which every float64 partial sum is still exact
+_FLOAT64_EXACT = 2**53
+
+# Check whether a sum of `length` products of ring elements fits exactly in float64
+def float64_exact(k: int, length: int) -> bool:
+    return length * (2**int(k) - 1) ** 2 < _FLOAT64_EXACT
+
+# Dot product over Z_{2^k} reduced in a single call. The accumulator is float64
+# (BLAS) while every partial sum is exactly representable, and uint64 otherwise,
+# whose wraparound mod 2^64 is also correct mod 2^k
+def ring_dot(a: np.ndarray, b: np.ndarray, k: int) -> int:
+    if float64_exact(k, a.shape[-1]):
+        result = int(np.dot(a.astype(np.float64), b.astype(np.float64)))
+    else:
+        result = int(np.dot(a.astype(np.uint64, copy=False), b.astype(np.uint64, copy=False)))
+    return result % 2**int(k)
+
+# Accumulator dtype for sums of `length` products of ring elements: float64
+# (BLAS) while every partial sum is exact, uint64 (wraparound) otherwise
+def accumulator_dtype(k: int, length: int) -> np.dtype:
+    if float64_exact(k, length):
+        return np.dtype(np.float64)
+    return np.dtype(np.uint64)
+
+# Widest limbs whose products summed over `length` terms are exact in float64
+def limb_bits(length: int) -> int:
+    bits = 26
+    while length * (2**bits - 1) ** 2 >= _FLOAT64_EXACT:
+        bits -= 1
+    return bits
+
+# Minimum number of columns of the right operand for the limb decomposition: below
+# it the product is bound by memory and the uint64 product is as fast
+LIMB_MIN_COLUMNS = 8
+
+# Matrix product over Z_{2^k} too wide for float64 (e.g. k = 32 or 64): the operands
+# are split into limbs of w bits, a = sum_i a_i 2^(w i), and the limb products
+# a_i b_j with w (i + j) < k are computed by BLAS in float64, exactly, then shifted
+# and summed with the uint64 wraparound
+def limb_matmul(a: np.ndarray, b: np.ndarray, k: int) -> np.ndarray:
+    k = int(k)
+    bits = limb_bits(a.shape[-1])
+    num_limbs = (k + bits - 1) // bits
+    mask = np.uint64(2**bits - 1)
+    a = a.astype(np.uint64, copy=False)
+    b = b.astype(np.uint64, copy=False)
+    a_limbs = [((a >> np.uint64(bits * i)) & mask).astype(np.float64) for i in range(num_limbs)]
+    b_limbs = [((b >> np.uint64(bits * j)) & mask).astype(np.float64) for j in range(num_limbs)]
+
+    result = np.zeros(a.shape[:-1] + b.shape[1:], dtype=np.uint64)
+    for i in range(num_limbs):
+        for j in range(num_limbs - i):
+            product = (a_limbs[i] @ b_limbs[j]).astype(np.uint64)
+            result += product << np.uint64(bits * (i + j))
+    return ring_reduce(result.astype(ring_dtype(k)), k)
+
+# Matrix product over Z_{2^k}. The operands may already be converted to the
+# accumulator dtype (see accumulator_dtype) to avoid repeated conversions
+def ring_matmul(a: np.ndarray, b: np.ndarray, k: int) -> np.ndarray:
+    accumulator = accumulator_dtype(k, a.shape[-1])
+    if accumulator == np.uint64 and b.ndim == 2 and b.shape[1] >= LIMB_MIN_COLUMNS:
+        return limb_matmul(a, b, k)
+    result = a.astype(accumulator, copy=False) @ b.astype(accumulator, copy=False)
+    if accumulator == np.float64:
+        result = result.astype(np.uint64)
+    return ring_reduce(np.asarray(result).astype(ring_dtype(k)), k)
+
+# Matrix-vector product over Z_{2^k}, with the same accumulator choice as ring_dot
+def ring_matvec(matrix: np.ndarray, vector: np.ndarray, k: int) -> np.ndarray:
+    return ring_matmul(matrix, vector, k)
@@ -0,0 +1,234 @@
+# Seed-compressed storage of replicated shares.
+# The dealer draws the components 1 and 2 of a sharing at random and only the component
+# 3 = x - x_1 - x_2 depends on the secret. Here the random components are not stored:
+# each one is the stream of a PRG seed given to the 2 parties holding it, and block b
+# of rows (block_rows rows) is the block `b` of that stream, so any range of rows is
+# re-expanded on the fly. Party 1 stores the component 3 and one seed, party 2 only
+# two seeds, and party 3 the component 3 and one seed: on average a third of the
+# uncompressed size, at the cost of one SHAKE-256 expansion per random block read.
+from __future__ import annotations
+import json
+import os
+import tempfile
+import numpy as np
+from MPC import MPC, MPC_ArrayShares
+from gallery import BLOCK_ELEMENTS, SharedGallery
+from prg import PRG, SEED_BYTES
+from ring import ring_dtype, ring_matvec, ring_reduce, to_ring
+from utils import mask_bits, signed_integer
+
+# On-disk format of a party's seed-compressed shares: a directory with the metadata
+# (including the seeds) in JSON and the stored component as a raw array
+SEEDED_FORMAT = 1
+SEEDED_META_FILE = "meta.json"
+COMPONENT_FILE = "component.bin"
+
+# Rows start .. stop of the component drawn from `seed` (block b of the rows is the
+# block b of the PRG stream; a partial block is a prefix of the full one)
+def expand_rows(seed: bytes, shape: tuple, block_rows: int, k: int, start: int, stop: int) -> np.ndarray:
+    assert 0 <= start <= stop <= shape[0], "Exception: The rows must be within the shares."
+    if start == stop:
+        return np.empty((0,) + tuple(shape[1:]), dtype=ring_dtype(k))
+    prg = PRG(seed)
+    first, last = start // block_rows, (stop - 1) // block_rows + 1
+    blocks = [prg.ExpandRing(b, (block_rows,) + tuple(shape[1:]), k) for b in range(first, last)]
+    component = np.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+    return component[start - first * block_rows:stop - first * block_rows]
+
+# Class to handle the seed-compressed shares of one party. The components are given
+# by index (party p holds the components p and p - 1): each one is either a seed or
+# an array with the full shape
+class SeededShares:
+    def __init__(
+        self, party: int, order: int, shape: tuple, block_rows: int, seeds: dict, stored: dict
+    ) -> SeededShares:
+        assert set(seeds) | set(stored) == {party, (party - 1) % 3}, "Exception: The party must hold its 2 components."
+        assert len(stored) <= 1, "Exception: Only the secret-dependent component is stored."
+        self.party = party
+        self.order = order
+        self.k = int(np.log2(order))
+        self.shape = tuple(shape)
+        self.block_rows = block_rows
+        self.seeds = {c: bytes(seed) for c, seed in seeds.items()}
+        self.stored = stored
+        self.dtype = ring_dtype(self.k)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    # Bytes held by this party (the stored component and the seeds)
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.stored.values()) + SEED_BYTES * len(self.seeds)
+
+    # Bytes of the same shares uncompressed
+    @property
+    def full_nbytes(self) -> int:
+        return 2 * int(np.prod(self.shape)) * self.dtype.itemsize
+
+    # Rows start .. stop of the component c
+    def _Component(self, c: int, start: int, stop: int) -> np.ndarray:
+        if c in self.stored:
+            return self.stored[c][start:stop]
+        return expand_rows(self.seeds[c], self.shape, self.block_rows, self.k, start, stop)
+
+    # Replicated shares of the rows start .. stop (all of them by default), clamped to
+    # the rows of the shares like a slice
+    def Expand(self, start: int = 0, stop: int = None) -> MPC_ArrayShares:
+        assert start >= 0, "Exception: The first row must not be negative."
+        stop = self.shape[0] if stop is None else min(stop, self.shape[0])
+        start = min(start, stop)
+        p = self.party
+        return MPC_ArrayShares(self._Component(p, start, stop), self._Component((p - 1) % 3, start, stop), p, self.order)
+
+    def Save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        for c, component in self.stored.items():
+            array = np.memmap(os.path.join(path, COMPONENT_FILE), dtype=self.dtype, mode="w+", shape=self.shape)
+            array[:] = component
+            array.flush()
+        meta = {
+            "format": SEEDED_FORMAT,
+            "party": self.party,
+            "order": self.order,
+            "k": self.k,
+            "dtype": self.dtype.name,
+            "shape": list(self.shape),
+            "block_rows": self.block_rows,
+            "seeds": {str(c): seed.hex() for c, seed in self.seeds.items()},
+            "stored": list(self.stored),
+        }
+        with open(os.path.join(path, SEEDED_META_FILE), "w") as f:
+            json.dump(meta, f)
+
+    # Open shares written by Save (the stored component is memory-mapped)
+    @classmethod
+    def Open(cls, path: str) -> SeededShares:
+        with open(os.path.join(path, SEEDED_META_FILE)) as f:
+            meta = json.load(f)
+        assert meta["format"] == SEEDED_FORMAT, "Exception: Unsupported seed-compressed format."
+        shape = tuple(meta["shape"])
+        stored = {
+            c: np.memmap(os.path.join(path, COMPONENT_FILE), dtype=np.dtype(meta["dtype"]), mode="r", shape=shape)
+            for c in meta["stored"]
+        }
+        seeds = {int(c): bytes.fromhex(seed) for c, seed in meta["seeds"].items()}
+        return cls(meta["party"], meta["order"], shape, meta["block_rows"], seeds, stored)
+
+# Class to handle the 1:N matching of a party against a seed-compressed gallery: the
+# random components are expanded one block of rows at a time, as the kernel reads them
+class SeededGallery:
+    def __init__(self, shares: SeededShares) -> SeededGallery:
+        assert len(shares.shape) == 2, "Exception: The gallery shares must be a matrix."
+        self.shares = shares
+        self.party = shares.party
+        self.order = shares.order
+        self.k = shares.k
+
+    @property
+    def num_codes(self) -> int:
+        return self.shares.shape[0]
+
+    @property
+    def vector_length(self) -> int:
+        return self.shares.shape[1]
+
+    def MemoryUsage(self) -> dict:
+        return {"stored_bytes": self.shares.nbytes, "full_bytes": self.shares.full_nbytes}
+
+    # Same as SharedGallery.LocalMatch, one block of seed expansion at a time
+    def LocalMatch(self, query_shares: MPC_ArrayShares, r: np.ndarray | int = 0, rows: tuple[int, int] = None) -> np.ndarray:
+        assert (
+            query_shares.party == self.party and query_shares.order == self.order
+        ), "Exception: The query shares must belong to the same party and order."
+        assert query_shares.shape == (
+            self.vector_length,
+        ), "Exception: The query must have the same length as the gallery codes."
+
+        k = self.k
+        q_sum = ring_reduce(query_shares.share_i + query_shares.share_j, k)
+        q_j = query_shares.share_j
+        first, last = rows if rows is not None else (0, self.num_codes)
+
+        # Blocks aligned on the seed blocks, so that every block is expanded once
+        block_rows = self.shares.block_rows
+        share_scores = np.empty(last - first, dtype=self.shares.dtype)
+        start = first
+        while start < last:
+            stop = min((start // block_rows + 1) * block_rows, last)
+            block = self.shares.Expand(start, stop)
+            g_sum = ring_reduce(block.share_i + block.share_j, k)
+            share_scores[start - first:stop - first] = ring_matvec(g_sum, q_sum, k) - ring_matvec(block.share_j, q_j, k)
+            start = stop
+
+        if not np.isscalar(r) or r != 0:
+            share_scores = share_scores + to_ring(r, k)
+        return ring_reduce(share_scores, k)
+
+    # Uncompressed gallery (for the operations of SharedGallery)
+    def ToGallery(self) -> SharedGallery:
+        return SharedGallery(self.shares.Expand())
+
+    def Save(self, path: str) -> None:
+        self.shares.Save(path)
+
+    @classmethod
+    def Open(cls, path: str) -> SeededGallery:
+        return cls(SeededShares.Open(path))
+
+# Dealer: split an array of secrets into seed-compressed shares of the 3 parties.
+# The seeds of the random components are fresh draws of the MPC generator
+def split_seeded(mpc: MPC, array, block_rows: int = None) -> tuple[SeededShares, SeededShares, SeededShares]:
+    k = int(mpc.k)
+    secret = to_ring(array, k)
+    shape = secret.shape
+    if block_rows is None:
+        block_rows = max(1, BLOCK_ELEMENTS // max(1, int(np.prod(shape[1:]))))
+    seed_1, seed_2 = mpc.prg.RandomBytes(SEED_BYTES), mpc.prg.RandomBytes(SEED_BYTES)
+
+    # Component 3 = x - x_1 - x_2, one block of rows at a time
+    share3 = np.empty(shape, dtype=ring_dtype(k))
+    for start in range(0, shape[0], block_rows):
+        stop = min(start + block_rows, shape[0])
+        share1 = expand_rows(seed_1, shape, block_rows, k, start, stop)
+        share2 = expand_rows(seed_2, shape, block_rows, k, start, stop)
+        share3[start:stop] = ring_reduce(secret[start:stop] - share1 - share2, k)
+
+    # Distribute the components among the parties (as in MPC.SplitArraySecret)
+    shares_obj_p1 = SeededShares(0, mpc.order, shape, block_rows, {0: seed_1}, {2: share3})
+    shares_obj_p2 = SeededShares(1, mpc.order, shape, block_rows, {1: seed_2, 0: seed_1}, {})
+    shares_obj_p3 = SeededShares(2, mpc.order, shape, block_rows, {1: seed_2}, {2: share3.copy()})
+    return shares_obj_p1, shares_obj_p2, shares_obj_p3
+
+# Split a plaintext gallery into the 3 parties' seed-compressed galleries
+def split_seeded_gallery(mpc: MPC, codes: np.ndarray, block_rows: int = None) -> tuple[SeededGallery, SeededGallery, SeededGallery]:
+    shares_p1, shares_p2, shares_p3 = split_seeded(mpc, np.atleast_2d(codes), block_rows)
+    return SeededGallery(shares_p1), SeededGallery(shares_p2), SeededGallery(shares_p3)
+##########################################################################################
+
+def seeded_test(num_codes: int = 2000, vector_length: int = 10000, match_index: int = 100, k: int = 16):
+    mpc = MPC(k)
+    codes_db = mask_bits(*np.random.randint(0, 2, (2, num_codes, vector_length)))
+    query = codes_db[match_index]
+    galleries = split_seeded_gallery(mpc, codes_db)
+    query_shares = mpc.SplitArraySecret(query)
+
+    # The expanded shares are a valid sharing, also after a round trip to disk
+    directory = tempfile.mkdtemp()
+    for p, gallery in enumerate(galleries):
+        gallery.Save(os.path.join(directory, f"party{p}"))
+    galleries = [SeededGallery.Open(os.path.join(directory, f"party{p}")) for p in range(3)]
+    expanded = [gallery.shares.Expand(5, 1500) for gallery in galleries]
+    assert np.array_equal(mpc.ReconstructArraySecret(expanded[0], expanded[2]), to_ring(codes_db[5:1500], k)), "Exception: Wrong shares."
+
+    z = [galleries[p].LocalMatch(query_shares[p]) for p in range(3)]
+    shares = mpc.ArrayResharing(*z)
+    scores = signed_integer(mpc.ReconstructArraySecret(shares[0], shares[1]), k)
+    assert np.array_equal(scores, codes_db @ query), "Exception: Wrong scores."
+
+    stored = [gallery.MemoryUsage()["stored_bytes"] for gallery in galleries]
+    full = galleries[0].MemoryUsage()["full_bytes"]
+    print(f"Stored bytes per party: {stored} (uncompressed {full}), {sum(stored) / (3 * full):.0%} on average")
+
+if __name__ == "__main__":
+    seeded_test()
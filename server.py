@@ -0,0 +1,281 @@
+# Pipelined query server of the 3-party matcher, driven by asyncio.
+# Each party keeps several queries in flight: while the local matrix-vector product
+# of a query runs in a worker thread (NumPy releases the GIL), the reshare and open
+# messages of the previous queries are sent and received on the event loop. Every
+# message is tagged with its query id, so the parties can interleave queries freely.
+from __future__ import annotations
+import asyncio
+import multiprocessing as mp
+import os
+import socket
+import struct
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from MPC import MPC, MPC_ArrayShares
+from correlated import ZeroSharing
+from gallery import SharedGallery, split_gallery
+from party_runtime import collect_results, picklable_error
+from prg import SEED_BYTES
+from ring import ring_reduce
+from utils import mask_bits, signed_integer
+from wire import decode_frame, encode_frame
+
+# Frame of a message between parties: query id, message kind and payload length
+FRAME = struct.Struct("<QBI")
+
+# Kinds of messages
+KIND_KEY = 0
+KIND_RESHARE = 1
+KIND_OPEN = 2
+
+# Kinds of the messages received from party p-1 and from party p+1
+KINDS_FROM_PREV = (KIND_KEY, KIND_RESHARE)
+KINDS_FROM_NEXT = (KIND_OPEN,)
+
+# Class to collect the latency of the queries and the throughput of the server
+class LatencyStats:
+    def __init__(self) -> LatencyStats:
+        self.latencies = []
+        self.start_time = None
+        self.end_time = None
+
+    def Record(self, latency: float) -> None:
+        self.latencies.append(latency)
+
+    def Summary(self) -> dict:
+        latencies = np.array(self.latencies)
+        if len(latencies) == 0:
+            return {"queries": 0, "p50_ms": None, "p99_ms": None, "qps": 0.0}
+        elapsed = self.end_time - self.start_time
+        return {
+            "queries": len(latencies),
+            "p50_ms": float(np.percentile(latencies, 50) * 1000),
+            "p99_ms": float(np.percentile(latencies, 99) * 1000),
+            "qps": len(latencies) / elapsed if elapsed > 0 else float("inf"),
+        }
+
+# Class to handle the pipelined query processing of one party
+class PartyServer:
+    def __init__(
+        self, party: int, gallery: SharedGallery, max_in_flight: int = 4, compute_threads: int = 2
+    ) -> PartyServer:
+        self.party = party
+        self.gallery = gallery
+        self.k = gallery.k
+        self.order = gallery.order
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=compute_threads)
+        self.stats = LatencyStats()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.zero_sharing = None
+
+        # Messages received from the neighbours, waiting for the query that needs them,
+        # and the (kind, query id) of all the messages received so far
+        self._inbox = {}
+        self._received = set()
+
+        # Error of the kinds of messages that will never come (their neighbour closed
+        # the connection, or sent a repeated message)
+        self._failed = {}
+
+    # Future of the message (kind, query id) coming from a neighbour
+    def _Expect(self, kind: int, query_id: int) -> asyncio.Future:
+        key = (kind, query_id)
+        if key not in self._inbox:
+            self._inbox[key] = asyncio.get_running_loop().create_future()
+            if kind in self._failed:
+                self._inbox[key].set_exception(self._failed[kind])
+        return self._inbox[key]
+
+    # Fail the queries waiting for a message of the given kinds, which will never come
+    def _Fail(self, kinds: tuple, error: Exception) -> None:
+        for kind in kinds:
+            self._failed.setdefault(kind, error)
+        for (kind, _), future in self._inbox.items():
+            if kind in kinds and not future.done():
+                future.set_exception(error)
+
+    # Read the frames sent by a neighbour (the messages of the given kinds) and hand them
+    # to the queries waiting for them. A neighbour which has sent all its messages may
+    # close the connection: only the queries still waiting for one of them fail then.
+    # A repeated message fails all the waiting queries
+    async def _Reader(self, reader: asyncio.StreamReader, kinds: tuple) -> None:
+        while True:
+            try:
+                header = await reader.readexactly(FRAME.size)
+                query_id, kind, length = FRAME.unpack(header)
+                payload = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                self._Fail(kinds, ConnectionError("Exception: A neighbour closed the connection."))
+                return
+            self.bytes_received += FRAME.size + length
+            if (kind, query_id) in self._received or kind not in kinds:
+                error = RuntimeError(f"Exception: Unexpected message of kind {kind} for the query {query_id}.")
+                self._Fail(KINDS_FROM_PREV + KINDS_FROM_NEXT, error)
+                return
+            self._received.add((kind, query_id))
+            self._Expect(kind, query_id).set_result(payload)
+
+    # Send a message made of one or more buffers (written without concatenating them)
+    async def _Send(self, writer: asyncio.StreamWriter, kind: int, query_id: int, parts) -> None:
+        parts = [memoryview(part) for part in (parts if isinstance(parts, list) else [parts])]
+        length = sum(part.nbytes for part in parts)
+        writer.write(FRAME.pack(query_id, kind, length))
+        for part in parts:
+            writer.write(part)
+        self.bytes_sent += FRAME.size + length
+        await writer.drain()
+
+    async def _Receive(self, kind: int, query_id: int) -> bytes:
+        payload = await self._Expect(kind, query_id)
+        del self._inbox[(kind, query_id)]
+        return payload
+
+    # Connect to party p+1 (this party's listening socket accepts party p-1)
+    async def Connect(self, listen_socket: socket.socket, address_next: tuple) -> None:
+        accepted = asyncio.get_running_loop().create_future()
+
+        async def on_connection(reader, writer):
+            accepted.set_result((reader, writer))
+
+        server = await asyncio.start_server(on_connection, sock=listen_socket)
+        self.reader_next, self.writer_next = await asyncio.open_connection(*address_next)
+        self.reader_prev, self.writer_prev = await accepted
+        server.close()
+
+        self._readers = [
+            asyncio.create_task(self._Reader(self.reader_next, KINDS_FROM_NEXT)),
+            asyncio.create_task(self._Reader(self.reader_prev, KINDS_FROM_PREV)),
+        ]
+
+        # Pairwise PRF keys: party p draws K_p and sends it to party p+1
+        key_own = os.urandom(SEED_BYTES)
+        await self._Send(self.writer_next, KIND_KEY, 0, key_own)
+        key_prev = await self._Receive(KIND_KEY, 0)
+        self.zero_sharing = ZeroSharing(self.party, key_own, key_prev, self.k)
+
+    # Process one query: local scoring, re-randomization, reshare and open
+    async def HandleQuery(self, query_id: int, query_shares: MPC_ArrayShares) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        r = self.zero_sharing.Derive(query_id, self.gallery.num_codes)
+        share_scores = await loop.run_in_executor(self.executor, self.gallery.LocalMatch, query_shares, r)
+
+        # Reshare: send z_p to party p+1, receive z_{p-1} from party p-1
+        await self._Send(self.writer_next, KIND_RESHARE, query_id, encode_frame([share_scores], self.k))
+        (share_prev,) = decode_frame(await self._Receive(KIND_RESHARE, query_id))
+
+        # Open: send component p to party p-1, receive component p+1 from party p+1
+        await self._Send(self.writer_prev, KIND_OPEN, query_id, encode_frame([share_scores], self.k))
+        (share_next,) = decode_frame(await self._Receive(KIND_OPEN, query_id))
+
+        return ring_reduce(share_scores + share_prev + share_next, self.k)
+
+    # Serve a stream of (query id, query shares), keeping up to max_in_flight queries
+    # in the pipeline. Returns the opened scores by query id
+    async def Serve(self, queries) -> dict:
+        slots = asyncio.Semaphore(self.max_in_flight)
+        results = {}
+
+        async def run(query_id, query_shares):
+            start = time.perf_counter()
+            try:
+                results[query_id] = await self.HandleQuery(query_id, query_shares)
+            finally:
+                self.stats.Record(time.perf_counter() - start)
+                slots.release()
+
+        self.stats.start_time = time.perf_counter()
+        tasks = []
+        query_ids = set()
+        for query_id, query_shares in queries:
+            # A repeated id would reuse the zero-sharing and the messages of a query
+            if query_id in query_ids:
+                raise ValueError(f"Exception: Repeated query id {query_id}.")
+            query_ids.add(query_id)
+            await slots.acquire()
+            tasks.append(asyncio.create_task(run(query_id, query_shares)))
+        await asyncio.gather(*tasks)
+        self.stats.end_time = time.perf_counter()
+        return results
+
+    async def Close(self) -> None:
+        for writer in (self.writer_next, self.writer_prev):
+            writer.close()
+        for task in self._readers:
+            task.cancel()
+        self.executor.shutdown()
+
+# Entry point of a party process. An exception is reported to the parent before the
+# process exits with it (closing the connections, which fails the neighbours' queries)
+def _server_main(party, gallery_path, queries, max_in_flight, listen_socket, address_next, result_queue):
+    async def main():
+        server = PartyServer(party, SharedGallery.Open(gallery_path), max_in_flight=max_in_flight)
+        await server.Connect(listen_socket, address_next)
+        try:
+            results = await server.Serve(queries)
+        finally:
+            await server.Close()
+        return results, server.stats.Summary(), server.bytes_sent, server.bytes_received
+
+    try:
+        result_queue.put((party, None, asyncio.run(main())))
+    except BaseException as error:
+        result_queue.put((party, picklable_error(error), None))
+        raise
+
+# Run the 3 party servers as processes on localhost. `queries_per_party[p]` is the
+# list of (query id, query shares) of party p. Returns per party the opened scores,
+# the latency/throughput summary and the bytes sent and received. If a party fails,
+# the others are stopped and its exception is raised here
+def run_servers(gallery_paths: list[str], queries_per_party: list[list], max_in_flight: int = 4) -> list[tuple]:
+    context = mp.get_context("fork")
+    result_queue = context.Queue()
+    sockets = [socket.create_server(("localhost", 0)) for _ in range(3)]
+    addresses = [s.getsockname()[:2] for s in sockets]
+
+    processes = [
+        context.Process(
+            target=_server_main,
+            args=(
+                party, gallery_paths[party], queries_per_party[party], max_in_flight,
+                sockets[party], addresses[(party + 1) % 3], result_queue,
+            ),
+        )
+        for party in range(3)
+    ]
+    for process in processes:
+        process.start()
+    for s in sockets:
+        s.close()
+
+    return collect_results(processes, result_queue)
+##########################################################################################
+
+def server_test(num_codes: int = 2000, vector_length: int = 10000, num_queries: int = 32, max_in_flight: int = 4, k: int = 16):
+    mpc = MPC(k)
+    codes_db = mask_bits(np.random.randint(0, 2, (num_codes, vector_length)), np.random.randint(0, 2, (num_codes, vector_length)))
+    codes_query = mask_bits(np.random.randint(0, 2, (num_queries, vector_length)), np.random.randint(0, 2, (num_queries, vector_length)))
+
+    # Enrollment of the gallery and splitting of the queries (dealer)
+    directory = tempfile.mkdtemp()
+    for gallery in split_gallery(mpc, codes_db):
+        gallery.Save(os.path.join(directory, f"party{gallery.party}"))
+    queries_per_party = [[], [], []]
+    for query_id, code_query in enumerate(codes_query):
+        for party, shares in enumerate(mpc.SplitArraySecret(code_query)):
+            queries_per_party[party].append((query_id, shares))
+
+    gallery_paths = [os.path.join(directory, f"party{p}") for p in range(3)]
+    results = run_servers(gallery_paths, queries_per_party, max_in_flight=max_in_flight)
+
+    reference = codes_query @ codes_db.T
+    for party, (scores, summary, bytes_sent, bytes_received) in enumerate(results):
+        for query_id in range(num_queries):
+            assert np.array_equal(signed_integer(scores[query_id], k), reference[query_id]), "Exception: Wrong scores."
+        print(f"Party {party + 1}: {summary}, sent {bytes_sent} bytes, received {bytes_received} bytes")
+
+if __name__ == "__main__":
+    server_test()
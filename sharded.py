@@ -0,0 +1,225 @@
+# Multi-core matching of one party: the gallery rows are sharded across a pool of
+# worker processes. Every worker attaches to the same share matrices, either
+# memory-mapped from the gallery directory or in shared memory (see shm.py), so
+# nothing is copied. The query shares and the score shares are exchanged through
+# shared memory as well: the workers write their row ranges of the score-share
+# vector in place and only small descriptors go through the pool.
+from __future__ import annotations
+import multiprocessing as mp
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+import numpy as np
+from MPC import MPC, MPC_ArrayShares
+from gallery import SharedGallery, enroll_codes, split_gallery, stored_generation
+from ring import ring_reduce, to_ring
+from shm import SharedShareBuffer
+from utils import mask_bits, signed_integer
+
+# Time allowed to the workers to start and meet at the warm-up barrier (s)
+WARM_UP_TIMEOUT = 60.0
+
+# State of each worker process: the attached gallery and shared buffers, its process
+# id and the barrier of the warm-up
+_worker_gallery = None
+_worker_source = None
+_worker_buffers = {}
+_worker_pid = None
+_worker_barrier = None
+
+# Attach the worker to the gallery: a directory (memory-mapped) or a shared memory descriptor
+def _attach(source, barrier=None) -> None:
+    global _worker_gallery, _worker_source, _worker_pid, _worker_barrier
+    _worker_pid = os.getpid()
+    if barrier is not None:
+        _worker_barrier = barrier
+    if isinstance(source, dict):
+        # Keep the buffer referenced: the arrays are views on its mappings
+        _worker_buffers["gallery"] = SharedShareBuffer.Attach(source)
+        _worker_gallery = SharedGallery(_worker_buffers["gallery"].shares)
+    else:
+        _worker_gallery = SharedGallery.Open(source)
+    _worker_source = source
+
+# Warm-up task: every worker of the pool runs one (they wait for each other at the
+# barrier) and returns its process id
+def _warm_up() -> int:
+    _worker_barrier.wait(WARM_UP_TIMEOUT)
+    return _worker_pid
+
+# Attach to the shared buffer with a role ("query" or "scores"), detaching from the
+# previous buffer of that role when the front-end has replaced it
+def _buffer(role: str, descriptor: dict) -> MPC_ArrayShares:
+    buffer = _worker_buffers.get(role)
+    if buffer is None or buffer.Descriptor()["names"] != descriptor["names"]:
+        if buffer is not None:
+            buffer.Close()
+        buffer = _worker_buffers[role] = SharedShareBuffer.Attach(descriptor)
+    return buffer.shares
+
+# Score the rows [start, stop) of the gallery against the shared query (or batch of
+# queries) and write the single shares in the shared score buffer
+def _score_rows(query_descriptor: dict, scores_descriptor: dict, start: int, stop: int, num_codes: int, generation: int) -> None:
+    # Attach again if the gallery has changed since the worker attached to it (a
+    # compaction replaces the files, possibly leaving the same number of rows). The
+    # rows must then be those of the front-end, otherwise its row positions would
+    # select other rows of a gallery changed on disk since
+    if _worker_gallery.num_codes != num_codes or _worker_gallery.generation != generation:
+        _attach(_worker_source)
+        assert (
+            _worker_gallery.num_codes == num_codes and _worker_gallery.generation == generation
+        ), "Exception: Stale gallery, the gallery has changed on disk (call Refresh)."
+
+    query_shares = _buffer("query", query_descriptor)
+    share_scores = _buffer("scores", scores_descriptor).share_i
+    if len(query_shares.shape) == 1:
+        share_scores[start:stop] = _worker_gallery.LocalMatch(query_shares, rows=(start, stop))
+    else:
+        gallery = SharedGallery(_worker_gallery.shares[start:stop])
+        share_scores[:, start:stop] = gallery.LocalMatchBatch(query_shares)
+
+# Class to handle the sharded matching of one party over a pool of workers.
+# `gallery` is a gallery directory or a SharedShareBuffer holding the gallery shares
+class ShardedMatcher:
+    def __init__(self, gallery, num_workers: int = None, shards_per_worker: int = 1) -> ShardedMatcher:
+        if isinstance(gallery, SharedShareBuffer):
+            source = gallery.Descriptor()
+            self.gallery = SharedGallery(gallery.shares)
+        else:
+            source = gallery
+            self.gallery = SharedGallery.Open(gallery)
+        self.source = source
+        self.num_workers = num_workers or os.cpu_count()
+        self.num_shards = self.num_workers * shards_per_worker
+        # The workers share the resource tracker of this process: one started by a
+        # worker would unlink the shared buffers it attached to when the worker exits
+        resource_tracker.ensure_running()
+        context = mp.get_context("fork")
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=context,
+            initializer=_attach,
+            initargs=(source, context.Barrier(self.num_workers)),
+        )
+
+        # Start all the workers now and record their process ids (e.g. to account
+        # for their CPU time)
+        warm_up = [self.pool.submit(_warm_up) for _ in range(self.num_workers)]
+        self.worker_pids = [future.result() for future in warm_up]
+
+        # Shared buffers of the query shares and of the score shares (reused while
+        # the shapes do not change)
+        self.query_buffer = None
+        self.scores_buffer = None
+
+    @property
+    def num_codes(self) -> int:
+        return self.gallery.num_codes
+
+    # Attach the front-end again after the gallery on disk has changed
+    def Refresh(self) -> None:
+        if not isinstance(self.source, dict):
+            self.gallery = SharedGallery.Open(self.source)
+
+    # Check that the gallery on disk is still the one attached by the front-end: the
+    # scores are returned for its rows
+    def _CheckFresh(self) -> None:
+        if not isinstance(self.source, dict):
+            assert (
+                stored_generation(self.source) == self.gallery.generation
+            ), "Exception: Stale gallery, the gallery has changed on disk (call Refresh)."
+
+    # Contiguous row ranges of the shards
+    def _Shards(self) -> list[tuple[int, int]]:
+        bounds = np.linspace(0, self.num_codes, self.num_shards + 1).astype(int)
+        return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+    # Shared buffer of the given shape, reallocated only when the shape changes
+    def _Reuse(self, buffer: SharedShareBuffer, shape: tuple, shares: MPC_ArrayShares) -> SharedShareBuffer:
+        if buffer is None or buffer.shape != shape:
+            if buffer is not None:
+                buffer.Close()
+            buffer = SharedShareBuffer.Create(shape, shares.dtype, shares.order, shares.party)
+        return buffer
+
+    # Compute this party's single shares of the scores of a query (vector) or a batch
+    # of queries (matrix) against the whole gallery, in parallel over the shards
+    def LocalMatch(self, query_shares: MPC_ArrayShares, r: np.ndarray | int = 0) -> np.ndarray:
+        assert (
+            query_shares.party == self.gallery.party and query_shares.order == self.gallery.order
+        ), "Exception: The query shares must belong to the same party and order."
+        self._CheckFresh()
+
+        # Hand the query over through shared memory
+        self.query_buffer = self._Reuse(self.query_buffer, query_shares.shape, query_shares)
+        self.query_buffer.shares.share_i[...] = query_shares.share_i
+        self.query_buffer.shares.share_j[...] = query_shares.share_j
+        scores_shape = query_shares.shape[:-1] + (self.num_codes,)
+        self.scores_buffer = self._Reuse(self.scores_buffer, scores_shape, query_shares)
+
+        # The workers write their row ranges of the score shares in place
+        query_descriptor = self.query_buffer.Descriptor()
+        scores_descriptor = self.scores_buffer.Descriptor()
+        futures = [
+            self.pool.submit(
+                _score_rows, query_descriptor, scores_descriptor, start, stop, self.num_codes, self.gallery.generation
+            )
+            for start, stop in self._Shards()
+        ]
+        for future in futures:
+            future.result()
+
+        share_scores = self.scores_buffer.shares.share_i.copy()
+        if not np.isscalar(r) or r != 0:
+            share_scores = share_scores + to_ring(r, self.gallery.k)
+        return ring_reduce(share_scores, self.gallery.k)
+
+    def Close(self) -> None:
+        self.pool.shutdown()
+        for buffer in (self.query_buffer, self.scores_buffer):
+            if buffer is not None:
+                buffer.Close()
+##########################################################################################
+
+def sharded_test(num_codes: int = 3000, vector_length: int = 1000, num_workers: int = 2, k: int = 16):
+    mpc = MPC(k)
+    codes_db = mask_bits(*np.random.randint(0, 2, (2, num_codes, vector_length)))
+    query_shares = mpc.SplitArraySecret(codes_db[100])
+    directory = tempfile.mkdtemp()
+    paths = [os.path.join(directory, f"party{p}") for p in range(3)]
+    for path, gallery in zip(paths, split_gallery(mpc, codes_db)):
+        gallery.Save(path)
+    matchers = [ShardedMatcher(path, num_workers=num_workers) for path in paths]
+
+    def scores() -> np.ndarray:
+        z = [matchers[p].LocalMatch(query_shares[p]) for p in range(3)]
+        shares = mpc.ArrayResharing(*z)
+        return signed_integer(mpc.ReconstructArraySecret(shares[0], shares[1]), k)
+
+    try:
+        assert np.array_equal(scores(), codes_db @ codes_db[100]), "Exception: Wrong scores."
+
+        # Another writer deletes rows, compacts and enrolls: the matchers refuse to
+        # score until they are refreshed, then score the new gallery
+        writers = [SharedGallery.Open(path, mode="r+") for path in paths]
+        for writer in writers:
+            writer.Delete(np.arange(10))
+            writer.Compact()
+        new_codes = mask_bits(*np.random.randint(0, 2, (2, 3, vector_length)))
+        enroll_codes(mpc, writers, new_codes)
+        try:
+            scores()
+            raise RuntimeError("Exception: The stale gallery was not detected.")
+        except AssertionError:
+            pass
+        for matcher in matchers:
+            matcher.Refresh()
+        expected = np.vstack([codes_db[10:], new_codes]) @ codes_db[100]
+        assert np.array_equal(scores(), expected), "Exception: Wrong scores after the refresh."
+    finally:
+        for matcher in matchers:
+            matcher.Close()
+
+if __name__ == "__main__":
+    sharded_test()
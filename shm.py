@@ -0,0 +1,74 @@
+# Share arrays living in multiprocessing.shared_memory segments.
+# A shared array is described by a small descriptor (segment names, dtype, shape,
+# order and party id) that can be sent to another process of the same party, which
+# attaches to the same memory: query shares and score shares are then handed over
+# by reference, without serialization. The segments belong to the process that
+# creates them; the processes attaching to them are forked from it (as the party
+# workers are), so they share its resource tracker and never unlink the segments.
+from __future__ import annotations
+from multiprocessing import shared_memory
+import numpy as np
+from MPC import MPC_ArrayShares
+
+# Class to handle a pair of replicated components stored in shared memory
+class SharedShareBuffer:
+    def __init__(
+        self, segments: tuple[shared_memory.SharedMemory, shared_memory.SharedMemory],
+        dtype: np.dtype, shape: tuple, order: int, party: int, owner: bool,
+    ) -> SharedShareBuffer:
+        self.segments = segments
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.order = order
+        self.party = party
+        self.owner = owner
+
+        # The shares are views on the shared memory
+        share_i = np.ndarray(self.shape, dtype=self.dtype, buffer=segments[0].buf)
+        share_j = np.ndarray(self.shape, dtype=self.dtype, buffer=segments[1].buf)
+        self.shares = MPC_ArrayShares(share_i, share_j, party, order)
+
+    # Allocate shared memory for shares of the given shape (and optionally copy them in)
+    @classmethod
+    def Create(
+        cls, shape: tuple, dtype: np.dtype, order: int, party: int, shares: MPC_ArrayShares = None
+    ) -> SharedShareBuffer:
+        size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        segments = tuple(shared_memory.SharedMemory(create=True, size=size) for _ in range(2))
+        buffer = cls(segments, dtype, shape, order, party, owner=True)
+        if shares is not None:
+            buffer.shares.share_i[...] = shares.share_i
+            buffer.shares.share_j[...] = shares.share_j
+        return buffer
+
+    # Copy existing shares into a new shared memory buffer
+    @classmethod
+    def FromShares(cls, shares: MPC_ArrayShares) -> SharedShareBuffer:
+        return cls.Create(shares.shape, shares.dtype, shares.order, shares.party, shares)
+
+    # Small picklable description of the buffer
+    def Descriptor(self) -> dict:
+        return {
+            "names": (self.segments[0].name, self.segments[1].name),
+            "dtype": self.dtype.str,
+            "shape": self.shape,
+            "order": self.order,
+            "party": self.party,
+        }
+
+    # Attach to a buffer created by another process from its descriptor
+    @classmethod
+    def Attach(cls, descriptor: dict) -> SharedShareBuffer:
+        segments = tuple(shared_memory.SharedMemory(name=name) for name in descriptor["names"])
+        return cls(
+            segments, descriptor["dtype"], descriptor["shape"],
+            descriptor["order"], descriptor["party"], owner=False,
+        )
+
+    # Detach from the shared memory (and free it if this process created it)
+    def Close(self) -> None:
+        self.shares = None
+        for segment in self.segments:
+            segment.close()
+            if self.owner:
+                segment.unlink()
@@ -0,0 +1,159 @@
+# Oblivious best-match selection on a shared score vector.
+# A tournament tree compares the scores two by two: at every level the pairs (a, b)
+# are compared in one batched secure comparison, the comparison bit beta = [a < b] is
+# converted to an arithmetic share and the winners are selected obliviously,
+#   winner = a + beta (b - a)
+# for the scores and for their (shared) gallery indices at once. After log2(N) levels
+# only the index and the score of the winner are opened. The top-k repeats the
+# tournament k times, excluding every opened winner (its index is public by then).
+# The same levels run along the first axis of a matrix of scores, e.g. to keep the
+# best of the S rotations of a query for every gallery row in log2(S) levels.
+from __future__ import annotations
+import numpy as np
+from MPC import MPC, MPC_ArrayShares
+from bitsliced import MPC_Bits
+from comparison import SecureComparison
+from correlated import ZeroSharing, setup_zero_sharing
+from gallery import split_gallery
+from utils import mask_bits, signed_integer
+
+# Shares of public values (all in the component 0)
+def public_shares(values: np.ndarray, party: int, order: int, dtype: np.dtype) -> MPC_ArrayShares:
+    zeros = np.zeros(np.shape(values), dtype=dtype)
+    return MPC_ArrayShares(zeros, zeros.copy(), party, order).LocalAddPublic(values)
+
+# Class to handle the tournament of the 3 parties over shared score vectors
+class Tournament:
+    def __init__(
+        self, mpc: MPC, comparison: SecureComparison, zero_sharings: tuple[ZeroSharing, ZeroSharing, ZeroSharing]
+    ) -> Tournament:
+        self.mpc = mpc
+        self.comparison = comparison
+        self.zero_sharings = zero_sharings
+        self.k = int(mpc.k)
+
+        # Multiplication rounds of the oblivious selections (the comparison rounds
+        # are counted by the SecureComparison)
+        self.rounds = 0
+
+    # Keep the greater of every pair of shared (scores, indices), in one batch. The
+    # pairs are taken along the first axis, so the scores may be matrices whose
+    # columns are tournaments of their own (indices None: the scores only)
+    def _Level(self, scores: list[MPC_ArrayShares], indices: list[MPC_ArrayShares] = None) -> tuple[list, list]:
+        num_pairs = len(scores[0]) // 2
+        a, b = [s[0:2 * num_pairs:2] for s in scores], [s[1:2 * num_pairs:2] for s in scores]
+        shape = a[0].shape
+
+        beta = self.comparison.BitToArithmetic(self.comparison.LessThan(a, b))
+
+        # winner = a + beta (b - a), the products of the scores and indices in one round
+        z_scores = [beta[p].LocalMultiplication(b[p].LocalSubtraction(a[p]), r=self.zero_sharings[p].Next(shape)) for p in range(3)]
+        delta_scores = self.mpc.ArrayResharing(*z_scores)
+        winners = [a[p].LocalAddition(delta_scores[p]) for p in range(3)]
+        if indices is not None:
+            a_index, b_index = [s[0:2 * num_pairs:2] for s in indices], [s[1:2 * num_pairs:2] for s in indices]
+            z_indices = [beta[p].LocalMultiplication(b_index[p].LocalSubtraction(a_index[p]), r=self.zero_sharings[p].Next(shape)) for p in range(3)]
+            delta_indices = self.mpc.ArrayResharing(*z_indices)
+            winner_indices = [a_index[p].LocalAddition(delta_indices[p]) for p in range(3)]
+        self.rounds += 1
+
+        # An odd element goes to the next level unopposed
+        if len(scores[0]) % 2:
+            winners = [concatenate(winners[p], scores[p][-1:]) for p in range(3)]
+            if indices is not None:
+                winner_indices = [concatenate(winner_indices[p], indices[p][-1:]) for p in range(3)]
+        return winners, winner_indices if indices is not None else None
+
+    # Shares of the greatest shared score (signed) of every column of S x N shared
+    # scores, e.g. the best rotation of a query against every gallery row: the N
+    # tournaments run side by side, in log2(S) batched levels
+    def MaxRows(self, scores: list[MPC_ArrayShares]) -> list[MPC_ArrayShares]:
+        while len(scores[0]) > 1:
+            scores, _ = self._Level(scores)
+        return [s[0] for s in scores]
+
+    # Index and score of the greatest shared score (signed), opening nothing else
+    def Argmax(self, scores: list[MPC_ArrayShares]) -> tuple[int, int]:
+        indices = [public_shares(np.arange(len(scores[p])), p, scores[p].order, scores[p].dtype) for p in range(3)]
+        while len(scores[0]) > 1:
+            scores, indices = self._Level(scores, indices)
+        index = int(self.mpc.ReconstructArraySecret(indices[0], indices[1])[0])
+        score = int(signed_integer(self.mpc.ReconstructArraySecret(scores[0], scores[1]), self.k)[0])
+        return index, score
+
+    # Indices and scores of the `count` greatest shared scores, best first
+    def TopK(self, scores: list[MPC_ArrayShares], count: int) -> list[tuple[int, int]]:
+        minimum = -2**(self.k - 2)
+        winners = []
+        for _ in range(count):
+            index, score = self.Argmax(scores)
+            winners.append((index, score))
+
+            # Exclude the winner: its shares are replaced by the (public) minimum
+            excluded = np.arange(len(scores[0])) == index
+            scores = [
+                MPC_ArrayShares(np.where(excluded, 0, s.share_i), np.where(excluded, 0, s.share_j), s.party, s.order)
+                .LocalAddPublic(np.where(excluded, minimum, 0))
+                for s in scores
+            ]
+        return winners
+
+# Concatenation of 2 shared vectors of the same party
+def concatenate(a: MPC_ArrayShares, b: MPC_ArrayShares) -> MPC_ArrayShares:
+    return MPC_ArrayShares(
+        np.concatenate([a.share_i, b.share_i]), np.concatenate([a.share_j, b.share_j]), a.party, a.order
+    )
+##########################################################################################
+
+def topk_test(num_codes: int = 1000, vector_length: int = 10000, match_index: int = 100, count: int = 3, k: int = 32):
+    mpc = MPC(k)
+    zero_sharings = setup_zero_sharing(k)
+    comparison = SecureComparison(MPC_Bits(mpc), zero_sharings)
+    tournament = Tournament(mpc, comparison, zero_sharings)
+
+    codes_db, masks_db = np.random.randint(0, 2, (2, num_codes, vector_length))
+    code_query, mask_query = codes_db[match_index], masks_db[match_index]
+    masked_codes_db = mask_bits(codes_db, masks_db)
+    galleries = split_gallery(mpc, masked_codes_db)
+    query_shares = mpc.SplitArraySecret(mask_bits(code_query, mask_query))
+
+    z = [galleries[p].LocalMatch(query_shares[p], r=zero_sharings[p].Next(num_codes)) for p in range(3)]
+    winners = tournament.TopK(list(mpc.ArrayResharing(*z)), count)
+
+    # Reference (ties are broken by any of the equal scores)
+    reference = masked_codes_db @ mask_bits(code_query, mask_query)
+    expected = np.sort(reference)[::-1][:count]
+    assert [score for _, score in winners] == expected.tolist(), "Exception: Wrong top scores."
+    assert all(reference[index] == score for index, score in winners), "Exception: Wrong top indices."
+    assert winners[0][0] == match_index, "Exception: The enrolled code must be the best match."
+    print(f"Top {count}: {winners} ({comparison.rounds + tournament.rounds} rounds)")
+
+# Rotation-tolerant search: the query is a rotated copy of an enrolled code, every
+# row is scored at all the shifts in one batched product and the best shift of every
+# row is kept obliviously before the argmax
+def rotation_test(num_codes: int = 1000, vector_length: int = 10000, match_index: int = 100, max_shift: int = 8, k: int = 32):
+    mpc = MPC(k)
+    zero_sharings = setup_zero_sharing(k)
+    comparison = SecureComparison(MPC_Bits(mpc), zero_sharings)
+    tournament = Tournament(mpc, comparison, zero_sharings)
+    shifts = list(range(-max_shift, max_shift + 1))
+
+    codes_db, masks_db = np.random.randint(0, 2, (2, num_codes, vector_length))
+    masked_codes_db = mask_bits(codes_db, masks_db)
+    query = np.roll(masked_codes_db[match_index], 5)
+    galleries = split_gallery(mpc, masked_codes_db)
+    query_shares = mpc.SplitArraySecret(query)
+
+    z = [galleries[p].LocalMatchRotations(query_shares[p], shifts, r=zero_sharings[p].Next((len(shifts), num_codes))) for p in range(3)]
+    best = tournament.MaxRows(list(mpc.ArrayResharing(*z)))
+    index, score = tournament.Argmax(best)
+
+    # Reference: the best score of every row over the shifts
+    reference = np.stack([masked_codes_db @ np.roll(query, shift) for shift in shifts]).max(axis=0)
+    assert np.array_equal(signed_integer(mpc.ReconstructArraySecret(best[0], best[1]), k), reference), "Exception: Wrong best scores."
+    assert index == match_index and score == reference[match_index], "Exception: The rotated code must be the best match."
+    print(f"Best match over {len(shifts)} shifts: {index} with score {score} ({comparison.rounds + tournament.rounds} rounds)")
+
+if __name__ == "__main__":
+    topk_test()
+    rotation_test()
@@ -0,0 +1,20 @@
+# Helper functions shared by the MPC scripts
+import numpy as np
+
+# Interpret an element of the ring Z_{2^k} as a signed integer (two's complement)
+def signed_integer(value, k: int):
+    half = 2**(int(k) - 1)
+    if isinstance(value, np.ndarray):
+        value = value.astype(np.int64) if value.dtype != np.uint64 else value.view(np.int64)
+        if k < 64:
+            value = np.where(value >= half, value - 2 * half, value)
+        return value
+    value = int(value)
+    if value >= half:
+        value -= 2 * half
+    return value
+
+# Masked bit representation
+def mask_bits(vector, mask):
+    masked_vector = mask - 2*(np.bitwise_and(vector, mask))
+    return masked_vector
@@ -0,0 +1,90 @@
+# Compact wire format of the messages between parties.
+# Ring elements are packed at exactly k bits each (k = 16 gives 2 bytes per element),
+# and all the arrays sent in one round go in a single frame:
+#   frame   = count (uint16) | count x message header | count x payload
+#   header  = k (uint8) | ndim (uint8) | ndim x dimension (uint32)
+#   payload = ceil(size * k / 8) bytes, little-endian, bit-packed when k is not a
+#             native width
+# Native widths are sent straight from the NumPy buffers through memoryviews, and
+# received arrays are views into the received buffer (no extra copies).
+from __future__ import annotations
+import struct
+import numpy as np
+from ring import ring_dtype
+
+FRAME_HEADER = struct.Struct("<H")
+MESSAGE_HEADER = struct.Struct("<BB")
+DIMENSION = struct.Struct("<I")
+
+# Number of bytes of `count` ring elements packed at k bits each
+def packed_size(count: int, k: int) -> int:
+    return (count * int(k) + 7) // 8
+
+# Pack an array of ring elements at exactly k bits per element
+def pack_ring(array: np.ndarray, k: int) -> memoryview:
+    k = int(k)
+    dtype = ring_dtype(k).newbyteorder("<")
+    array = np.ascontiguousarray(array, dtype=dtype)
+    if k == dtype.itemsize * 8:
+        return memoryview(array).cast("B")
+
+    # Keep the k low bits of every element and pack them back to back
+    bits = np.unpackbits(array.view(np.uint8).reshape(-1, dtype.itemsize), axis=1, bitorder="little")
+    return memoryview(np.packbits(bits[:, :k], bitorder="little"))
+
+# Unpack `shape` ring elements packed by pack_ring
+def unpack_ring(buffer, k: int, shape: tuple) -> np.ndarray:
+    k = int(k)
+    dtype = ring_dtype(k).newbyteorder("<")
+    count = int(np.prod(shape))
+    data = np.frombuffer(buffer, dtype=np.uint8, count=packed_size(count, k))
+    if k == dtype.itemsize * 8:
+        return data.view(dtype).reshape(shape)
+
+    bits = np.unpackbits(data, count=count * k, bitorder="little").reshape(count, k)
+    padded = np.zeros((count, dtype.itemsize * 8), dtype=np.uint8)
+    padded[:, :k] = bits
+    return np.packbits(padded, axis=1, bitorder="little").view(dtype).reshape(shape)
+
+# Encode the arrays of one round as the parts of a single frame (header, payloads),
+# ready to be written one after the other without concatenating them
+def encode_frame(arrays: list[np.ndarray], k: int) -> list[memoryview]:
+    header = bytearray(FRAME_HEADER.pack(len(arrays)))
+    payloads = []
+    for array in arrays:
+        array = np.asarray(array)
+        header += MESSAGE_HEADER.pack(int(k), array.ndim)
+        header += b"".join(DIMENSION.pack(n) for n in array.shape)
+        payloads.append(pack_ring(array, k))
+    return [memoryview(header)] + payloads
+
+# Encode the arrays of one round as a single buffer
+def frame_bytes(arrays: list[np.ndarray], k: int) -> bytearray:
+    parts = encode_frame(arrays, k)
+    frame = bytearray(sum(part.nbytes for part in parts))
+    offset = 0
+    for part in parts:
+        frame[offset:offset + part.nbytes] = part
+        offset += part.nbytes
+    return frame
+
+# Decode a frame into its arrays (views into the buffer for native widths)
+def decode_frame(buffer) -> list[np.ndarray]:
+    buffer = memoryview(buffer).cast("B")
+    (count,) = FRAME_HEADER.unpack_from(buffer)
+    offset = FRAME_HEADER.size
+
+    headers = []
+    for _ in range(count):
+        k, ndim = MESSAGE_HEADER.unpack_from(buffer, offset)
+        offset += MESSAGE_HEADER.size
+        shape = tuple(DIMENSION.unpack_from(buffer, offset + i * DIMENSION.size)[0] for i in range(ndim))
+        offset += ndim * DIMENSION.size
+        headers.append((k, shape))
+
+    arrays = []
+    for k, shape in headers:
+        size = packed_size(int(np.prod(shape)), k)
+        arrays.append(unpack_ring(buffer[offset:offset + size], k, shape))
+        offset += size
+    return arrays